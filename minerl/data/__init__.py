@@ -1,12 +1,16 @@
 from minerl.data.data_pipeline import DataPipeline
 from minerl.data.download import download
+from minerl.data.frame_cache import FrameCache, build_frame_cache
+from minerl.data.trajectory import Trajectory
 import os
 
 from minerl.data.version import DATA_VERSION, FILE_PREFIX, VERSION_FILE_NAME
 
 import minerl.data.version
 
-def make(environment=None , data_dir=None,num_workers=4, worker_batch_size=32, minimum_size_to_dequeue=32, force_download=False):
+def make(environment=None , data_dir=None,num_workers=4, worker_batch_size=32, minimum_size_to_dequeue=32, force_download=False,
+         use_frame_cache=False, frame_cache_max_bytes=None, trajectory_filter=None, transform=None,
+         executor='processes', decoder='cv2', observation_keys=None, action_keys=None):
     """
     Initalizes the data loader with the chosen environment
     
@@ -15,6 +19,21 @@ def make(environment=None , data_dir=None,num_workers=4, worker_batch_size=32, m
         data_dir (string, optional): specify alternative dataset location. Defaults to None.
         num_workers (int, optional): number of files to load at once. Defaults to 4.
         force_download (bool, optional): specifies whether or not the data should be downloaded if missing. Defaults to False.
+        use_frame_cache (bool, optional): read POV frames from a memory-mapped cache of decoded frames (see
+            minerl.data.build_frame_cache) instead of decoding the videos. Defaults to False.
+        frame_cache_max_bytes (int, optional): maximum size of the frame cache, least recently used trajectories
+            are evicted beyond it. Defaults to None (unlimited).
+        trajectory_filter (callable, optional): only iterate over the trajectories whose summary (see
+            DataPipeline.get_trajectory_metadata) satisfies this predicate. Defaults to None (all trajectories).
+        transform (callable, optional): picklable transform(observation, rng) of the observations, run by the workers
+            before the data is sent to the trainer (see DataPipeline). Defaults to None.
+        executor (string, optional): load the trajectories in worker 'processes', in 'threads' of this process
+            (without pickling or copying their arrays) or 'inline' in the iterating thread. Defaults to 'processes'.
+        decoder (string, optional): the video decoder backend, 'cv2' or 'ffmpeg' (requires the ffmpeg executable).
+            Defaults to 'cv2'.
+        observation_keys (list, optional): only load these top-level keys of the observations, e.g. ['inventory'].
+            The recordings are not decoded unless 'pov' is one of them. Defaults to None (all of them).
+        action_keys (list, optional): only load these top-level keys of the actions. Defaults to None (all of them).
 
     Returns:
         DataPipeline: initalized data pipeline
@@ -46,7 +65,15 @@ def make(environment=None , data_dir=None,num_workers=4, worker_batch_size=32, m
         environment,
         num_workers,
         worker_batch_size,
-        minimum_size_to_dequeue
+        minimum_size_to_dequeue,
+        use_frame_cache=use_frame_cache,
+        frame_cache_max_bytes=frame_cache_max_bytes,
+        trajectory_filter=trajectory_filter,
+        transform=transform,
+        executor=executor,
+        decoder=decoder,
+        observation_keys=observation_keys,
+        action_keys=action_keys
     )
     return d
 
@@ -55,9 +82,19 @@ def reset():
     raise NotImplementedError()
 
 
-def filter_data(fn):
-    raise NotImplementedError()
-    pass
+def filter_data(data, fn):
+    """
+    Restricts a data pipeline to the trajectories whose metadata satisfies fn, without opening any video.
+
+    Args:
+        data (DataPipeline): the data pipeline to filter
+        fn (callable): predicate over trajectory summaries (see DataPipeline.get_trajectory_metadata), e.g.
+            lambda t: t['success'] and t['final_inventory']['diamond'] > 0
+
+    Returns:
+        DataPipeline: the filtered data pipeline
+    """
+    return data.filter(fn)
 
 
 def sample():
@@ -0,0 +1,110 @@
+import collections
+import itertools
+
+import numpy as np
+
+
+def _allocate(value, batch_size, seq_len):
+    if isinstance(value, dict):
+        return collections.OrderedDict([(k, _allocate(v, batch_size, seq_len)) for k, v in value.items()])
+    value = np.asanyarray(value)
+    return np.zeros((batch_size, seq_len) + value.shape[1:], dtype=value.dtype)
+
+
+def _fill(dst, src, row, length):
+    if isinstance(dst, dict):
+        for k in dst:
+            _fill(dst[k], src[k], row, length)
+    else:
+        dst[row, :length] = src[:length]
+        dst[row, length:] = 0
+
+
+def _clear(dst, row):
+    if isinstance(dst, dict):
+        for v in dst.values():
+            _clear(v, row)
+    else:
+        dst[row] = 0
+
+
+class BatchBuffer:
+    """
+    Preallocated (batch_size, seq_len, ...) arrays which sequences of (state, player_action,
+    reward_from_action, next_state, is_next_state_terminal) are collated into, one per row.
+
+    Sequences shorter than seq_len are padded with zeros and a boolean mask marks the valid
+    steps. The arrays are allocated from the first sequence added and reused for every batch.
+    """
+
+    def __init__(self, batch_size: int, seq_len: int):
+        self.batch_size = batch_size
+        self.seq_len = seq_len
+        self.arrays = None
+        self.mask = np.zeros((batch_size, seq_len), dtype=bool)
+        self.num_rows = 0
+
+    def add(self, sequence):
+        """Copies a sequence into the next free row, truncating it to seq_len steps.
+
+        Args:
+            sequence (tuple): (state, player_action, reward_from_action, next_state, is_next_state_terminal)
+                with a leading step axis.
+        """
+        if self.full:
+            raise ValueError("The batch is full.")
+        if self.arrays is None:
+            self.arrays = [_allocate(part, self.batch_size, self.seq_len) for part in sequence[:5]]
+
+        length = min(len(sequence[2]), self.seq_len)
+        for dst, src in zip(self.arrays, sequence[:5]):
+            _fill(dst, src, self.num_rows, length)
+        self.mask[self.num_rows, :length] = True
+        self.mask[self.num_rows, length:] = False
+        self.num_rows += 1
+
+    @property
+    def full(self):
+        return self.num_rows == self.batch_size
+
+    def batch(self):
+        """Returns the batch (masking out unfilled rows) as a tuple of
+        (state, player_action, reward_from_action, next_state, is_next_state_terminal, mask).
+        """
+        for row in range(self.num_rows, self.batch_size):
+            for dst in self.arrays:
+                _clear(dst, row)
+            self.mask[row] = False
+        return tuple(self.arrays) + (self.mask,)
+
+    def reset(self):
+        """Marks every row as free, keeping the arrays for the next batch."""
+        self.num_rows = 0
+
+
+def collate(sequences, buffers):
+    """Collates sequences into the batches of several BatchBuffers, filling them in turn.
+
+    A yielded batch remains valid until len(buffers) - 1 further batches have been yielded, so
+    the next batches can be collated ahead while the caller uses it.
+
+    Args:
+        sequences (iterable): The sequences to collate, e.g. those yielded by DataPipeline.sarsd_iter.
+        buffers (list): The BatchBuffers to fill.
+
+    Yields:
+        The batches of BatchBuffer.batch, the last one possibly with masked out rows.
+    """
+    buffers = itertools.cycle(buffers)
+    buffer = next(buffers)
+    buffer.reset()
+    for sequence in sequences:
+        buffer.add(sequence)
+        del sequence
+        if buffer.full:
+            yield buffer.batch()
+            buffer = next(buffers)
+            buffer.reset()
+
+    if buffer.num_rows > 0:
+        yield buffer.batch()
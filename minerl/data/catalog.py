@@ -0,0 +1,224 @@
+import json
+import logging
+import os
+
+import gym
+
+from minerl.data.frame_index import load_frame_index
+from minerl.data.npz_reader import NpzReader
+from minerl.data.trajectory import load_metadata
+from minerl.data.version import assert_prefix
+
+logger = logging.getLogger(__name__)
+
+CATALOG_FILE_NAME = 'catalog.json'
+CATALOG_VERSION = 1
+
+# Files of a trajectory whose changes invalidate its summary.
+_SOURCE_FILES = ['metadata.json', 'rendered.npz']
+
+# Files of a trajectory as distributed, whose sizes are listed in its summary.
+_DATA_FILES = ['metadata.json', 'recording.mp4', 'rendered.npz']
+
+
+def _mtime(path):
+    return os.stat(path).st_mtime
+
+
+def _scan_recordings(path):
+    """Lists the trajectory directories under path (those containing an mp4 and an npz), asserting their version.
+    """
+    from minerl.data.data_pipeline import DataPipeline
+
+    if os.path.isfile(path) or DataPipeline._is_blacklisted(path):
+        return []
+
+    names = os.listdir(path)
+    directory_list = []
+    if any(f.endswith('.mp4') for f in names) and any(f.endswith('.npz') for f in names):
+        assert_prefix(path)
+        directory_list.append(path)
+
+    for d in names:
+        new_path = os.path.join(path, d)
+        if os.path.isdir(new_path):
+            directory_list += _scan_recordings(new_path)
+    return directory_list
+
+
+def summarize_trajectory(file_dir, environment):
+    """Summarizes a trajectory from its metadata.json and rendered.npz, without decoding its recording.
+
+    Args:
+        file_dir (str): The trajectory directory.
+        environment (str): The MineRL environment the trajectory was recorded in.
+
+    Returns:
+        A dict of the trajectory's metadata (with success corrected for the environment) together with
+        environment, num_steps (the number of steps in rendered.npz), num_frames (the number of frames of
+        the recording if it is indexed, otherwise None), file_sizes ({file name: size}) and final_inventory
+        (the item counts of the last state, empty if the environment has no inventory).
+    """
+    state = NpzReader(os.path.join(file_dir, 'rendered.npz'))
+    num_states = len(state['reward']) + 1
+
+    summary = dict(load_metadata(file_dir, environment, state))
+    summary['environment'] = environment
+    summary['num_steps'] = num_states - 1
+    summary['num_frames'] = None
+    summary['file_sizes'] = {name: os.path.getsize(os.path.join(file_dir, name)) for name in _DATA_FILES
+                             if os.path.exists(os.path.join(file_dir, name))}
+    _update_num_frames(summary, file_dir)
+
+    summary['final_inventory'] = {}
+    observation_space = gym.envs.registration.spec(environment)._kwargs['observation_space']
+    if 'inventory' in observation_space.spaces and 'observation_inventory' in state:
+        final_inventory = state['observation_inventory'][-1]
+        for column, item in enumerate(observation_space.spaces['inventory'].spaces):
+            summary['final_inventory'][item] = int(final_inventory[column])
+    return summary
+
+
+def _update_num_frames(summary, file_dir):
+    """Fills in the frame count of a summary once the trajectory's recording has been indexed."""
+    try:
+        index = load_frame_index(file_dir, summary['num_steps'] + 1, build=False)
+    except OSError:
+        return False
+    if index is None or index['num_frames'] == summary['num_frames']:
+        return False
+    summary['num_frames'] = index['num_frames']
+    return True
+
+
+class Catalog:
+    """
+    A persistent listing of the trajectories of a data root, with a summary of each of them.
+
+    The catalog is stored in the data root and read instead of walking the data directories.
+    The listing of an environment is rescanned when the modification time of its directory
+    changes (i.e. when trajectories are added or removed), and the summary of a trajectory is
+    rebuilt when its metadata.json or rendered.npz changes.
+    """
+
+    def __init__(self, data_root: str):
+        """
+        Args:
+            data_root (str): The MineRL data root containing the environment directories.
+        """
+        self.data_root = data_root
+        self.path = os.path.join(data_root, CATALOG_FILE_NAME)
+        self._changed = False
+        try:
+            with open(self.path) as f:
+                self._table = json.load(f)
+            if self._table.get('version') != CATALOG_VERSION:
+                raise ValueError("Unsupported catalog version.")
+        except (OSError, ValueError):
+            self._table = {'version': CATALOG_VERSION, 'root_environments': None, 'environments': {}}
+
+    def _environment(self, environment):
+        """Returns the catalog entry of an environment, rescanning its directory if it changed."""
+        env_dir = os.path.join(self.data_root, environment)
+        mtime = _mtime(env_dir)
+        entry = self._table['environments'].get(environment)
+        if entry is not None and entry['mtime'] == mtime:
+            return entry
+
+        old_trajectories = entry['trajectories'] if entry is not None else {}
+        trajectories = {}
+        for file_dir in _scan_recordings(env_dir):
+            name = os.path.relpath(file_dir, env_dir)
+            trajectories[name] = old_trajectories.get(name)
+        entry = {'mtime': mtime, 'trajectories': trajectories}
+        self._table['environments'][environment] = entry
+        self._changed = True
+        return entry
+
+    def file_dirs(self, environment):
+        """Gets the trajectory directories of an environment, in sorted order.
+
+        Args:
+            environment (str): The name of the environment directory.
+
+        Returns:
+            A list of trajectory directories.
+        """
+        trajectories = self._environment(environment)['trajectories']
+        file_dirs = [os.path.join(self.data_root, environment, name) for name in sorted(trajectories)]
+        self.save()
+        return file_dirs
+
+    def summaries(self, environment, file_dirs=None, env_str=None):
+        """Gets the summaries of an environment's trajectories (see summarize_trajectory).
+
+        Args:
+            environment (str): The name of the environment directory.
+            file_dirs (list, optional): The trajectory directories to summarize. Defaults to all of them.
+            env_str (str, optional): The MineRL environment the trajectories were recorded in. Defaults to
+                the name of the environment directory.
+
+        Returns:
+            A dict from the trajectory directories to their summaries.
+        """
+        trajectories = self._environment(environment)['trajectories']
+        env_dir = os.path.join(self.data_root, environment)
+        if file_dirs is None:
+            file_dirs = [os.path.join(env_dir, name) for name in sorted(trajectories)]
+
+        summaries = {}
+        for file_dir in file_dirs:
+            name = os.path.relpath(file_dir, env_dir)
+            mtime = max(_mtime(os.path.join(file_dir, f)) for f in _SOURCE_FILES)
+            row = trajectories.get(name)
+            if row is None or row['mtime'] != mtime:
+                row = {'mtime': mtime, 'summary': summarize_trajectory(file_dir, env_str or environment)}
+                trajectories[name] = row
+                self._changed = True
+            elif row['summary']['num_frames'] is None and _update_num_frames(row['summary'], file_dir):
+                self._changed = True
+            summaries[file_dir] = row['summary']
+        self.save()
+        return summaries
+
+    def is_current(self):
+        """Returns whether every environment directory of the data root is listed and unchanged.
+        """
+        try:
+            # The catalog itself lives in the data root, so compare its listing rather than its mtime.
+            if self._table['root_environments'] != self._root_environments():
+                return False
+            return all(
+                environment in self._table['environments']
+                and self._table['environments'][environment]['mtime'] == _mtime(
+                    os.path.join(self.data_root, environment))
+                for environment in self._table['root_environments'])
+        except (OSError, KeyError):
+            return False
+
+    def refresh(self):
+        """Lists every environment directory of the data root (those whose name contains MineRL).
+        """
+        environments = self._root_environments()
+        for environment in environments:
+            self._environment(environment)
+        self._table['root_environments'] = environments
+        self._changed = True
+        self.save()
+
+    def _root_environments(self):
+        return sorted(d for d in os.listdir(self.data_root)
+                      if 'MineRL' in d and os.path.isdir(os.path.join(self.data_root, d)))
+
+    def save(self):
+        """Writes the catalog if it changed. Failures (e.g. a read-only data root) are ignored."""
+        if not self._changed:
+            return
+        try:
+            tmp_path = '{}.{}.tmp'.format(self.path, os.getpid())
+            with open(tmp_path, 'w') as f:
+                json.dump(self._table, f)
+            os.replace(tmp_path, self.path)
+            self._changed = False
+        except OSError as e:
+            logger.debug("Could not write the catalog of {}: {}".format(self.data_root, e))
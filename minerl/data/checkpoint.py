@@ -0,0 +1,138 @@
+import collections
+import copy
+import threading
+
+
+class IteratorState:
+    """
+    The progress of a data pipeline iterator: its epoch, the order of its trajectories and the
+    windows of each trajectory which were delivered to the caller.
+
+    Windows are recorded per epoch as they are delivered, so windows which were loaded but not
+    delivered yet (e.g. waiting in a shuffle buffer) are loaded again when resuming. An epoch is
+    forgotten once all of its windows were loaded and delivered. Windows may be loaded by a
+    prefetch thread while they are delivered in the caller's thread.
+    """
+
+    def __init__(self):
+        # The first epoch which was not completely delivered.
+        self.epoch = 0
+        # The trajectories (relative to the data directory) in the order of the first epoch.
+        self.order = None
+        # {epoch: {trajectory: [start of each delivered window]}}
+        self.delivered = {}
+        # {trajectory: number of windows}
+        self.num_windows = {}
+        self.rng_state = None
+
+        # Windows loaded but not delivered yet, and epochs which were completely loaded, by epoch.
+        self._pending = collections.Counter()
+        self._loaded = set()
+        self._lock = threading.Lock()
+
+    def skipped_windows(self, epoch, trajectory):
+        """Returns the starts of the windows of a trajectory which were already delivered in an epoch, or None
+        if all of them were.
+        """
+        starts = self.delivered.get(epoch, {}).get(trajectory, [])
+        num_windows = self.num_windows.get(trajectory)
+        if num_windows is not None and len(starts) >= num_windows:
+            return None
+        return list(starts)
+
+    def loaded(self, epoch):
+        """Records that a window of an epoch was loaded."""
+        with self._lock:
+            self._pending[epoch] += 1
+
+    def finished_loading(self, epoch):
+        """Records that every window of an epoch was loaded."""
+        with self._lock:
+            self._loaded.add(epoch)
+            self._advance()
+
+    def deliver(self, epoch, trajectory, start, num_windows):
+        """Records that a window of an epoch was delivered to the caller."""
+        with self._lock:
+            self._pending[epoch] -= 1
+            self.num_windows[trajectory] = num_windows
+            self.delivered.setdefault(epoch, {}).setdefault(trajectory, []).append(start)
+            self._advance()
+
+    def _advance(self):
+        while self.epoch in self._loaded and self._pending[self.epoch] <= 0:
+            self.delivered.pop(self.epoch, None)
+            self.epoch += 1
+
+    def state_dict(self):
+        with self._lock:
+            return copy.deepcopy({
+                'epoch': self.epoch,
+                'order': self.order,
+                'delivered': self.delivered,
+                'num_windows': self.num_windows,
+                'rng_state': self.rng_state,
+            })
+
+    @classmethod
+    def from_state_dict(cls, state_dict):
+        state = cls()
+        state_dict = copy.deepcopy(state_dict)
+        state.epoch = state_dict['epoch']
+        state.order = state_dict['order']
+        state.delivered = {int(epoch): trajectories for epoch, trajectories in state_dict['delivered'].items()}
+        state.num_windows = state_dict['num_windows']
+        state.rng_state = state_dict['rng_state']
+        return state
+
+
+class ResumableIterator:
+    """
+    An iterator over the sequences of a data pipeline which can be checkpointed and resumed.
+
+    :code:`state_dict()` captures the epoch, the order of the trajectories, the windows of each
+    trajectory delivered so far and the state of the shuffle random state. An iterator created
+    with the same arguments and given that state with :code:`load_state_dict(state)` continues
+    where the checkpointed one stopped, without loading the trajectories it had finished.
+    """
+
+    def __init__(self, make_items, rng=None):
+        """
+        Args:
+            make_items (callable): Creates an iterator of (item, (epoch, trajectory, start, num_windows)) from an
+                IteratorState, which it updates as it loads the windows.
+            rng (np.random.RandomState, optional): The random state of the shuffle buffer, if any.
+        """
+        self._make_items = make_items
+        self._rng = rng
+        self._state = IteratorState()
+        self._items = None
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self._items is None:
+            self._items = self._make_items(self._state)
+        item, (epoch, trajectory, start, num_windows) = next(self._items)
+        self._state.deliver(epoch, trajectory, start, num_windows)
+        return item
+
+    def state_dict(self):
+        """Returns the progress of the iterator as a dict of picklable values."""
+        if self._rng is not None:
+            self._state.rng_state = self._rng.get_state()
+        return self._state.state_dict()
+
+    def load_state_dict(self, state_dict):
+        """Restores the progress saved by state_dict, restarting the iteration from there."""
+        self.close()
+        self._state = IteratorState.from_state_dict(state_dict)
+        if self._rng is not None and self._state.rng_state is not None:
+            self._rng.set_state(self._state.rng_state)
+
+    def close(self):
+        """Stops loading data, the iteration restarts from the current state if continued."""
+        if self._items is not None:
+            self._items.close()
+            self._items = None
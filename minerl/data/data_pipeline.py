@@ -1,42 +1,82 @@
 import collections
 import functools
-import json
 import logging
 import multiprocessing
+import multiprocessing.pool
 import os
-import time
+import threading
 from collections import OrderedDict
-from queue import PriorityQueue, Empty
+from queue import PriorityQueue, Empty, Full, Queue
 from typing import List, Tuple, Any
-from itertools import cycle, islice
+from itertools import cycle, islice, starmap
 from minerl.env import spaces
 
-import cv2
 import os
 import numpy as np
 import gym
 
 logger = logging.getLogger(__name__)
 
-from minerl.data.version import assert_version, assert_prefix
+from minerl.data.batching import BatchBuffer, collate
+from minerl.data.frame_cache import FrameCache
+from minerl.data.prefetch import prefetch as _prefetch
+from minerl.data.catalog import Catalog
+from minerl.data.decoders import get_decoder, read_frame
+from minerl.data.checkpoint import ResumableIterator
+from minerl.data.shared_memory_queue import SharedMemoryQueue, _ALIGNMENT, _flatten
+from minerl.data.shuffle_buffer import shuffle_buffer
+from minerl.data.sampling import PrioritizedSampler, TransitionIndex, shard_trajectories
+from minerl.data.space_plan import SpacePlan, get_space_plans, select_space
+from minerl.data.trajectory import Trajectory, concatenate_windows, split_sequence
+from minerl.data.version import assert_version
 
 if os.name != "nt":
     class WindowsError(OSError):
         pass
 
+# How the trajectories of a data pipeline are loaded (see DataPipeline).
+EXECUTORS = ('processes', 'threads', 'inline')
+
+
+class InlinePool:
+    """A stand-in for the worker pool of the 'inline' executor, which runs every task in the calling thread."""
+
+    def starmap(self, func, iterable):
+        return list(starmap(func, iterable))
+
+    def terminate(self):
+        pass
+
+    def join(self):
+        pass
+
 
 class DataPipeline:
     """
     Creates a data pipeline object used to itterate through the MineRL-v0 dataset
     """
 
+    # Number of steps decoded at a time by load_data.
+    _LOAD_DATA_WINDOW = 32
+
+    # Seconds a worker waits on a full queue before handing the rest of its trajectory back to the consumer.
+    _HANDBACK_TIMEOUT = 1.0
+
     def __init__(self,
                  data_directory: os.path,
                  environment: str,
                  num_workers: int,
                  worker_batch_size: int,
                  min_size_to_dequeue: int,
-                 random_seed=42):
+                 random_seed=42,
+                 use_frame_cache=False,
+                 frame_cache_max_bytes=None,
+                 trajectory_filter=None,
+                 transform=None,
+                 executor='processes',
+                 decoder='cv2',
+                 observation_keys=None,
+                 action_keys=None):
         """
         Sets up a tensorflow dataset to load videos from a given data directory.
         :param data_directory:
@@ -48,17 +88,109 @@ class DataPipeline:
         :param min_size_to_dequeue:
         :type min_size_to_dequeue:
         :param random_seed:
+        :param use_frame_cache: read POV frames from a memory-mapped cache of decoded frames, decoding
+            recordings into it on a miss
+        :param frame_cache_max_bytes: maximum size of the frame cache across the data root, the least recently
+            used trajectories are evicted beyond it
+        :param trajectory_filter: a predicate over trajectory summaries (see get_trajectory_metadata), only the
+            trajectories it accepts are iterated over and sampled from
+        :param transform: a picklable transform(observation, rng) of the observations of each loaded window, run in
+            the workers before the arrays are sent to this process (see Trajectory), e.g. to resize frames. The
+            observation_space is not updated to its output. The shared memory slots of sarsd_iter are sized from the
+            transformed first window, so transforms whose output size varies between windows should not grow it
+        :param executor: how trajectories are loaded: 'processes' (a pool of worker processes), 'threads' (a pool of
+            threads of this process, whose arrays are handed over without copying, as decoding releases the GIL) or
+            'inline' (one after another in the iterating thread)
+        :param decoder: the video decoder backend, 'cv2', 'ffmpeg' (an ffmpeg subprocess, see
+            minerl.data.decoders.FFmpegDecoder) or a VideoDecoder subclass
+        :param observation_keys: the top-level keys of the observation space to load, e.g. ['inventory'], or None
+            for all of them. Only their arrays are read from the trajectories and the recordings are only decoded
+            if 'pov' is one of them. The observation_space is restricted to them
+        :param action_keys: the top-level keys of the action space to load, or None for all of them. The
+            action_space is restricted to them
         """
+        if executor not in EXECUTORS:
+            raise ValueError("executor must be one of {}.".format(", ".join(EXECUTORS)))
+        # Missing backends are reported here, rather than only logged by the workers.
+        get_decoder(decoder).check_available()
         self.seed = random_seed
         self.data_dir = data_directory
         self.environment = environment
         self.number_of_workers = num_workers
         self.worker_batch_size = worker_batch_size
         self.size_to_dequeue = min_size_to_dequeue
+        self.trajectory_filter = trajectory_filter
+        self.transform = transform
+        self.executor = executor
+        self.decoder = decoder
+        self.observation_keys = observation_keys
+        self.action_keys = action_keys
+        self._frame_cache_max_bytes = frame_cache_max_bytes
+        if use_frame_cache:
+            self._frame_cache = FrameCache(self._data_root, frame_cache_max_bytes, decoder)
+        else:
+            self._frame_cache = None
+        self._transition_index = None
+        self._pool = None
+        self._manager = None
+        # The stop events of the running iterators.
+        self._stop_events = set()
+        self._sample_rng = np.random.RandomState(self.seed)
+        # (rank, world_size, seed) of a sharded pipeline.
+        self._shard = None
+
+        spec = gym.envs.registration.spec(self.environment)
+        self._action_space = select_space(spec._kwargs['action_space'], action_keys)
+        self._observation_space = select_space(spec._kwargs['observation_space'], observation_keys)
+        self._observation_plan, self._action_plan = get_space_plans(self.environment, observation_keys, action_keys)
 
-        self._action_space = gym.envs.registration.spec(self.environment)._kwargs['action_space']
-        self._observation_space = gym.envs.registration.spec(self.environment)._kwargs['observation_space']
 
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def __del__(self):
+        try:
+            self.close()
+        except Exception:
+            pass
+
+    def close(self):
+        """
+        Stops the worker processes of the pipeline. Iterators of the pipeline can not be used afterwards,
+        but new ones start a new pool.
+        """
+        for stop_event in list(self._stop_events):
+            try:
+                stop_event.set()
+            except (OSError, EOFError):
+                pass
+        if self._pool is not None:
+            # Worker threads are joined, so they must not be waiting on the iterators' queues.
+            self._pool.terminate()
+            self._pool.join()
+            self._pool = None
+        if self._manager is not None:
+            self._manager.shutdown()
+            self._manager = None
+
+    def _get_pool(self):
+        """Returns the worker pool shared by every iterator of the pipeline, starting it on first use."""
+        if self._pool is None:
+            if self.executor == 'processes':
+                self._pool = multiprocessing.Pool(self.number_of_workers)
+            elif self.executor == 'threads':
+                self._pool = multiprocessing.pool.ThreadPool(self.number_of_workers)
+            else:
+                self._pool = InlinePool()
+        return self._pool
+
+    def _get_manager(self):
+        if self._manager is None:
+            self._manager = multiprocessing.Manager()
+        return self._manager
 
     @property
     def action_space(self):
@@ -93,30 +225,11 @@ class DataPipeline:
 
     @staticmethod
     def map_to_dict(handler_list: list, target_space: gym.spaces.space):
+        """Maps a handler list (the npz arrays ordered by key, with pov last) to the nested dict of target_space.
 
-        def _map_to_dict(i: int, src: list, key: str, gym_space: gym.spaces.space, dst: dict):
-            if isinstance(gym_space, spaces.Dict):
-                dont_count = False
-                inner_dict = collections.OrderedDict()
-                for idx, (k, s) in enumerate(gym_space.spaces.items()):
-                    if key in ['equipped_items', 'mainhand']:
-                        dont_count = True
-                        i = _map_to_dict(i, src, k, s, inner_dict)
-                    else:
-                        _map_to_dict(idx, src[i].T, k, s, inner_dict)
-                dst[key] = inner_dict
-                if dont_count:
-                    return i
-                else:
-                    return i + 1
-            else:
-                dst[key] = src[i]
-                return i + 1
-        result = collections.OrderedDict()
-        index = 0
-        for key, space in target_space.spaces.items():
-            index = _map_to_dict(index, handler_list, key, space, result)
-        return result
+        The pipeline itself applies SpacePlans compiled once per environment instead.
+        """
+        return SpacePlan(target_space)(handler_list)
 
     def seq_iter(self, num_epochs=-1, max_sequence_len=32, queue_size=None, seed=None, include_metadata=False):
         """DEPRECATED METHOD FOR SAMPLING DATA FROM THE MINERL DATASET.
@@ -128,9 +241,11 @@ class DataPipeline:
             "\nNOTE: The new method `DataPipeline.sarsd_iter` has a different return signature! "
             "\n\t  Please see how to use it @ http://www.minerl.io/docs/tutorials/data_sampling.html")
 
-    def sarsd_iter(self, num_epochs=-1, max_sequence_len=32, queue_size=None, seed=None, include_metadata=False, epoch_size=None):
+    def sarsd_iter(self, num_epochs=-1, max_sequence_len=32, queue_size=None, seed=None, include_metadata=False, epoch_size=None,
+                   use_shared_memory=True, shuffle_buffer_size=None, shuffle_buffer_bytes=None, skip_interval=0,
+                   aggregate_actions=False, frame_stack=1, prefetch=2):
         """
-        Returns a generator for iterating through (state, action, reward, next_state, is_terminal)
+        Returns a resumable iterator through (state, action, reward, next_state, is_terminal)
         tuples in the dataset.
         Loads num_workers files at once as defined in minerl.data.make() and return up to
         max_sequence_len consecutive samples wrapped in a dict observation space
@@ -139,88 +254,254 @@ class DataPipeline:
             num_epochs (int, optional): number of epochs to iterate over or -1
                 to loop forever. Defaults to -1
             max_sequence_len (int, optional): maximum number of consecutive samples - may be less. Defaults to 32
-            seed (int, optional): seed for random directory walk - note, specifying seed as well as a finite num_epochs
-                will cause the ordering of examples to be the same after every call to seq_iter
+            seed (int, optional): seed for random directory walk and shuffle buffer - note, specifying seed as well as a
+                finite num_epochs will cause the ordering of examples to be the same after every call to seq_iter
             queue_size (int, optional): maximum number of elements to buffer at a time, each worker may hold an
                 additional item while waiting to enqueue. Defaults to 16*self.number_of_workers or 2*
                 self.number_of_workers if max_sequence_len == -1
             include_metadata (bool, optional): adds an additional member to the tuple containing metadata about the
                 stream the data was loaded from. Defaults to False
+            use_shared_memory (bool, optional): move the arrays from the workers through shared memory rather than
+                pickling them through the manager queue (requires Python 3.8 and max_sequence_len != -1). The yielded
+                arrays are then views into shared memory which is reused once they are garbage collected.
+                Defaults to True
+            shuffle_buffer_size (int, optional): shuffle the sequences through a pool of up to this many sequences
+                from many trajectories (with max_sequence_len=1, of transitions). Defaults to None (no shuffling)
+            shuffle_buffer_bytes (int, optional): shuffle the sequences through a pool holding up to this many bytes
+                of arrays. May be combined with shuffle_buffer_size. Defaults to None (no shuffling)
+            skip_interval (int, optional): number of time steps to skip between each sample, the frames in between
+                are skipped without being decoded (see Trajectory). Defaults to 0 (every state)
+            aggregate_actions (bool, optional): merge the actions and rewards of the skipped steps into the kept ones:
+                camera deltas and rewards are summed, binary keys are OR-ed and enums keep any value other than
+                'none'. Defaults to False
+            frame_stack (int, optional): stack the frames of the frame_stack latest states in each pov, of shape
+                (frame_stack, H, W, C), padding with the first frame at the start of episodes. The stacks are strided
+                views into one block of frames, in the workers and (through shared memory) in this process. Defaults
+                to 1 (no stacking)
+            prefetch (int, optional): number of sequences a background thread receives from the workers and prepares
+                (and shuffles) ahead of the caller, which only waits when none is ready. Defaults to 2, 0 prepares
+                them in the caller's thread
+
+        The returned iterator can be checkpointed with state_dict() and resumed by an iterator created with the
+        same arguments with load_state_dict(state) (see ResumableIterator). Trajectories which were completely
+        delivered are not loaded again; sequences waiting in the shuffle buffer at the checkpoint are.
 
         Yields:
             A tuple of (state, player_action, reward_from_action, next_state, is_next_state_terminal, (metadata)).
             Each element is in the format of the environment action/state/reward space and contains as many
             samples are requested.
         """
+        shuffle = shuffle_buffer_size is not None or shuffle_buffer_bytes is not None
+        rng = np.random.RandomState(seed) if shuffle else None
+
+        def make_sequences(state):
+            sequences = self._sarsd_iter(state, num_epochs, max_sequence_len, queue_size, seed, include_metadata,
+                                         epoch_size, use_shared_memory, skip_interval, aggregate_actions, frame_stack,
+                                         prefetch)
+            if shuffle:
+                # Sequences are copied out of shared memory while they wait in the pool.
+                sequences = shuffle_buffer(sequences, shuffle_buffer_size, shuffle_buffer_bytes, rng=rng,
+                                           copy=use_shared_memory)
+            return _prefetch(sequences, prefetch)
+
+        return ResumableIterator(make_sequences, rng)
+
+    def _sarsd_iter(self, state, num_epochs, max_sequence_len, queue_size, seed, include_metadata, epoch_size,
+                    use_shared_memory, skip_interval, aggregate_actions, frame_stack, prefetch=0):
+        """Yields the sequences of sarsd_iter together with their (epoch, trajectory, start, num_windows), starting
+        from an IteratorState which is updated as the windows are loaded.
+        """
         logger.debug("Starting seq iterator on {}".format(self.data_dir))
-        if seed is not None:
-            np.random.seed(seed)
-        data_list = self._get_all_valid_recordings(self.data_dir)
-        if epoch_size is not None:
-            data_list = data_list[0:epoch_size]
+        if state.order is None:
+            if seed is not None:
+                np.random.seed(seed)
+            data_list = self._get_trajectory_dirs()
+            state.order = [os.path.relpath(file_dir, self.data_dir) for file_dir in data_list]
+        else:
+            data_list = [os.path.join(self.data_dir, name) for name in state.order]
 
-        m = multiprocessing.Manager()
         if queue_size is not None:
             max_size = queue_size
         elif max_sequence_len == -1:
             max_size = 2*self.number_of_workers
         else:
             max_size = 16*self.number_of_workers
-        data_queue = m.Queue(maxsize=max_size)
+        # The stop event is set when the iterator is closed, so that workers of the shared pool stop loading its files.
+        data_queue, stop_event = None, None
+        if self.executor == 'processes':
+            m = self._get_manager()
+            if use_shared_memory and max_sequence_len != -1 and data_list and SharedMemoryQueue.is_available():
+                try:
+                    # Leave slots for the batches being written by the workers, prefetched and held by the consumer.
+                    data_queue = SharedMemoryQueue(m, max_size,
+                                                   max_size + self.number_of_workers + max(prefetch, 0) + 3,
+                                                   self._batch_nbytes(data_list[0], max_sequence_len, skip_interval,
+                                                                      aggregate_actions, frame_stack))
+                except OSError as e:
+                    logger.warning("Could not allocate shared memory for the data pipeline: {}".format(e))
+            if data_queue is None:
+                data_queue = m.Queue(maxsize=max_size)
+            stop_event = m.Event()
+        elif self.executor == 'threads':
+            # The workers' arrays are handed over as they are.
+            data_queue = Queue(maxsize=max_size)
+            stop_event = threading.Event()
+        if stop_event is not None:
+            self._stop_events.add(stop_event)
         logger.debug(str(self.number_of_workers) + str(max_size))
 
-        # Setup arguments for the workers.
-        files = [(file_dir, max_sequence_len, data_queue, self.environment, 0, include_metadata) for file_dir in data_list]
+        epoch = state.epoch
 
-        epoch = 0
+        try:
+            while epoch < num_epochs or num_epochs == -1:
+                # Sharded pipelines reshuffle and reassign the trajectories to the ranks every epoch.
+                if self._shard is not None and epoch > 0:
+                    data_list = self._get_trajectory_dirs(epoch)
+                epoch_list = data_list[0:epoch_size] if epoch_size is not None else data_list
+
+                # Setup arguments for the workers, leaving out what was delivered before a checkpoint.
+                files = []
+                for file_dir in epoch_list:
+                    skip_windows = state.skipped_windows(epoch, os.path.relpath(file_dir, self.data_dir))
+                    if skip_windows is not None:
+                        files.append((file_dir, max_sequence_len, data_queue, self.environment, skip_interval,
+                                      include_metadata, self._frame_cache, stop_event, aggregate_actions,
+                                      self.transform, self.seed, frame_stack, skip_windows, self.decoder,
+                                      self.observation_keys, self.action_keys, 0))
 
-        while epoch < num_epochs or num_epochs == -1:
+                # We map the files -> load_data -> batch_pool -> random shuffle -> yield.
+                if self.executor == 'inline':
+                    windows = DataPipeline._load_data_inline(files)
+                else:
+                    windows = self._receive(data_queue, files)
+
+                for sequence, (file_dir, start_idx, num_windows) in windows:
+                    position = (epoch, os.path.relpath(file_dir, self.data_dir), start_idx, num_windows)
+                    state.loaded(epoch)
+                    if include_metadata:
+                        observation_seq, action_seq, reward_seq, next_observation_seq, done_seq, meta = \
+                            split_sequence(sequence)
+                    else:
+                        observation_seq, action_seq, reward_seq, next_observation_seq, done_seq = \
+                            split_sequence(sequence)
+                    del sequence
+
+                    # Wrap in dict
+                    observation_dict = self._observation_plan(observation_seq)
+                    action_dict = self._action_plan(action_seq)
+                    next_observation_dict = self._observation_plan(next_observation_seq)
+
+                    if include_metadata:
+                        yield ((observation_dict, action_dict, reward_seq[0], next_observation_dict, done_seq[0],
+                                meta), position)
+                    else:
+                        yield (observation_dict, action_dict, reward_seq[0], next_observation_dict,
+                               done_seq[0]), position
 
-            # Debug
-            # for arg1, arg2, arg3 in files:
-            #     DataPipeline._load_data_pyfunc(arg1, arg2, arg3)
-            #     break
-            with multiprocessing.Pool(self.number_of_workers) as pool:
-                map_promise = pool.starmap_async(DataPipeline._load_data_pyfunc, files, error_callback=None)
+                state.finished_loading(epoch)
+                epoch += 1
+        finally:
+            try:
+                if stop_event is not None:
+                    self._stop_events.discard(stop_event)
+                    stop_event.set()
+            except (OSError, EOFError):
+                # The pipeline was closed first.
+                pass
+            if isinstance(data_queue, SharedMemoryQueue):
+                data_queue.close()
+        logger.debug("Epoch complete.")
 
-                # random_queue = PriorityQueue(maxsize=pool_size)
+    def batch_iter(self, batch_size=None, seq_len=32, num_epochs=-1, seed=None, prefetch=2, **kwargs):
+        """
+        Returns a generator of fixed shape batches of sequences from several trajectories.
 
-                # We map the files -> load_data -> batch_pool -> random shuffle -> yield.
-                while True:
-                    try:
-                        sequence = data_queue.get_nowait()
-                        if include_metadata:
-                            observation_seq, action_seq, reward_seq, next_observation_seq, done_seq, meta = sequence
-                        else:
-                            observation_seq, action_seq, reward_seq, next_observation_seq, done_seq = sequence
-
-                        # Wrap in dict
-                        gym_spec = gym.envs.registration.spec(self.environment)
-
-                        observation_dict = DataPipeline.map_to_dict(observation_seq, gym_spec._kwargs['observation_space'])
-                        action_dict = DataPipeline.map_to_dict(action_seq, gym_spec._kwargs['action_space'])
-                        next_observation_dict = DataPipeline.map_to_dict(next_observation_seq, gym_spec._kwargs['observation_space'])
-
-                        if include_metadata:
-                            yield observation_dict, action_dict, reward_seq[0], next_observation_dict, done_seq[0], meta
-                        else:
-                            yield observation_dict, action_dict, reward_seq[0], next_observation_dict, done_seq[0]
-
-                    except Empty:
-                        if map_promise.ready():
-                            epoch += 1
-                            break
-                        else:
-                            time.sleep(0.1)
-        logger.debug("Epoch complete.")
+        Sequences of up to seq_len consecutive samples are loaded as in sarsd_iter and collated
+        one per row into (batch_size, seq_len, ...) arrays. Rows are padded with zeros and a
+        boolean mask marks the valid steps, so every batch has the same shapes. The arrays are
+        allocated once and refilled: a yielded batch is only valid until the next one is requested.
+
+        Args:
+            batch_size (int, optional): number of sequences per batch. Defaults to worker_batch_size as defined in
+                minerl.data.make()
+            seq_len (int, optional): number of steps per sequence. Defaults to 32
+            num_epochs (int, optional): number of epochs to iterate over or -1 to loop forever. Defaults to -1
+            seed (int, optional): seed for random directory walk. Defaults to None
+            prefetch (int, optional): number of batches a background thread collates ahead of the caller into
+                further preallocated arrays. Defaults to 2, 0 collates them in the caller's thread
+            **kwargs: further arguments to sarsd_iter, e.g. skip_interval
+
+        Yields:
+            A tuple of (state, player_action, reward_from_action, next_state, is_next_state_terminal, mask)
+            where every array has a leading (batch_size, seq_len) shape. The last batch of the final epoch may
+            have fully masked rows.
+        """
+        if batch_size is None:
+            batch_size = self.worker_batch_size
+        # The caller's batch and the prefetched ones stay valid while the thread fills the next one.
+        buffers = [BatchBuffer(batch_size, seq_len) for _ in range(prefetch + 2 if prefetch > 0 else 1)]
+        sequences = self.sarsd_iter(num_epochs=num_epochs, max_sequence_len=seq_len, seed=seed, prefetch=0, **kwargs)
+        yield from _prefetch(collate(sequences, buffers), prefetch)
+
+    def column_iter(self, num_epochs=1, seed=None, include_metadata=False, skip_interval=0, aggregate_actions=False):
+        """Iterates over whole trajectories as columns of arrays, without their pov.
+
+        Only rendered.npz is read, the recordings are never opened or indexed, so a pass over the
+        dataset is bounded by reading the arrays of the (observation_keys other than pov and
+        action_keys of the) pipeline. The trajectories are loaded in the calling thread, without
+        the transform.
+
+        Args:
+            num_epochs (int, optional): number of epochs to iterate over or -1 to loop forever. Defaults to 1.
+            seed (int, optional): seed for the order of the trajectories. Defaults to None.
+            include_metadata (bool, optional): adds an additional member to the tuple containing metadata about the
+                trajectory. Defaults to False.
+            skip_interval (int, optional): number of time steps to skip between each sample (see sarsd_iter).
+                Defaults to 0 (every state).
+            aggregate_actions (bool, optional): merge the actions and rewards of the skipped steps into the kept ones
+                (see sarsd_iter). Defaults to False.
+
+        Yields:
+            A tuple of (state, player_action, reward_from_action, next_state, is_next_state_terminal, (metadata))
+            per trajectory, whose arrays have a leading axis of every step of the trajectory.
+        """
+        observation_keys = [key for key in self._observation_space.spaces if key != 'pov']
+        if seed is not None:
+            np.random.seed(seed)
+        file_dirs = self._get_trajectory_dirs()
 
-    def load_data(self, stream_name: str, skip_interval=0, include_metadata=False):
+        epoch = 0
+        while epoch < num_epochs or num_epochs == -1:
+            # Sharded pipelines reshuffle and reassign the trajectories to the ranks every epoch.
+            if self._shard is not None and epoch > 0:
+                file_dirs = self._get_trajectory_dirs(epoch)
+            for file_dir in file_dirs:
+                trajectory = Trajectory(file_dir, self.environment, skip_interval=skip_interval,
+                                        aggregate_actions=aggregate_actions, observation_keys=observation_keys,
+                                        action_keys=self.action_keys)
+                try:
+                    if len(trajectory) == 0:
+                        continue
+                    columns = trajectory[:]
+                    if include_metadata:
+                        columns += (trajectory.metadata,)
+                finally:
+                    trajectory.close()
+                yield columns
+            epoch += 1
+
+    def load_data(self, stream_name: str, skip_interval=0, include_metadata=False, aggregate_actions=False,
+                  frame_stack=1):
         """Iterates over an individual trajectory named stream_name.
         
         Args:
             stream_name (str): The stream name desired to be iterated through.
-            skip_interval (int, optional): How many sices should be skipped.. Defaults to 0.
+            skip_interval (int, optional): Number of time steps to skip between each sample, the frames in between
+                are skipped without being decoded. Defaults to 0 (every state).
             include_metadata (bool, optional): Whether or not meta data about the loaded trajectory should be included.. Defaults to False.
+            aggregate_actions (bool, optional): Merge the actions and rewards of the skipped steps into the kept ones
+                (see sarsd_iter). Defaults to False.
+            frame_stack (int, optional): The number of frames stacked in each pov (see sarsd_iter). Defaults to 1.
 
         Yields:
             A tuple of (state, player_action, reward_from_action, next_state, is_next_state_terminal).
@@ -234,25 +515,203 @@ class DataPipeline:
         if DataPipeline._is_blacklisted(stream_name):
             raise RuntimeError("This stream is corrupted (and will be removed in the next version of the data!)")
 
-        seq = DataPipeline._load_data_pyfunc(file_dir, -1, None, self.environment, skip_interval=skip_interval,
-                                             include_metadata=include_metadata)
+        trajectory = Trajectory(file_dir, self.environment, frame_cache=self._frame_cache, skip_interval=skip_interval,
+                                aggregate_actions=aggregate_actions, transform=self.transform, seed=self.seed,
+                                frame_stack=frame_stack, decoder=self.decoder,
+                                observation_keys=self.observation_keys, action_keys=self.action_keys)
         if include_metadata:
-            observation_seq, action_seq, reward_seq, next_observation_seq, done_seq, meta = seq
+            meta = trajectory.metadata
+
+        # Decode the trajectory in windows so that steps are yielded as soon as their frames are read.
+        try:
+            for start_idx in range(0, len(trajectory), DataPipeline._LOAD_DATA_WINDOW):
+                observation_seq, action_seq, reward_seq, next_observation_seq, done_seq = \
+                    trajectory.load_window(start_idx, start_idx + DataPipeline._LOAD_DATA_WINDOW)
+
+                # Wrap in dict
+                steps = zip(self._observation_plan.iter_steps(observation_seq),
+                            self._action_plan.iter_steps(action_seq),
+                            self._observation_plan.iter_steps(next_observation_seq))
+                for idx, (observation_dict, action_dict, next_observation_dict) in enumerate(steps):
+                    yield_list = [observation_dict, action_dict, reward_seq[0][idx], next_observation_dict, done_seq[0][idx]]
+                    yield yield_list + [meta] if include_metadata else yield_list
+        finally:
+            trajectory.close()
+
+    def trajectory(self, stream_name: str, skip_interval=0, aggregate_actions=False, frame_stack=1):
+        """Gets random access to an individual trajectory named stream_name.
+
+        Slicing the trajectory decodes only the frames of the requested window, e.g.
+        :code:`obs, act, rew, next_obs, done = data.trajectory(name)[t0:t1]`.
+
+        Args:
+            stream_name (str): The stream name of the trajectory.
+            skip_interval (int, optional): Number of time steps to skip between each sample. Defaults to 0 (every
+                state).
+            aggregate_actions (bool, optional): Merge the actions and rewards of the skipped steps into the kept ones
+                (see sarsd_iter). Defaults to False.
+            frame_stack (int, optional): The number of frames stacked in each pov (see sarsd_iter). Defaults to 1.
+
+        Returns:
+            Trajectory: the trajectory, whose length is its number of steps.
+        """
+        if '/' in stream_name:
+            file_dir = stream_name
         else:
-            observation_seq, action_seq, reward_seq, next_observation_seq, done_seq = seq
+            file_dir = os.path.join(self.data_dir, stream_name)
+
+        if DataPipeline._is_blacklisted(stream_name):
+            raise RuntimeError("This stream is corrupted (and will be removed in the next version of the data!)")
+
+        return Trajectory(file_dir, self.environment, frame_cache=self._frame_cache, skip_interval=skip_interval,
+                          aggregate_actions=aggregate_actions, transform=self.transform, seed=self.seed,
+                          frame_stack=frame_stack, decoder=self.decoder,
+                          observation_keys=self.observation_keys, action_keys=self.action_keys)
+
+    def sample(self, batch_size: int):
+        """Samples a minibatch of transitions uniformly over every step of every trajectory.
+
+        Only the frames of the sampled steps (and their next states) are decoded, by num_workers
+        worker processes. The trajectory lengths are read once and kept in a transition index.
+        Steps beyond the end of a trajectory whose recording turns out to be shorter than its
+        rendered.npz (before the recording is indexed) are dropped from the minibatch.
+
+        Args:
+            batch_size (int): The number of transitions to sample.
+
+        Returns:
+            A tuple of (state, player_action, reward_from_action, next_state, is_next_state_terminal)
+            in the format of the environment spaces with batch_size samples each.
+        """
+        index = self._get_transition_index()
+        trajectories, steps = index.locate(self._sample_rng.randint(len(index), size=batch_size))
+        return self._load_transitions(index, trajectories, steps)[0]
+
+    def prioritized_sampler(self, alpha=0.6, beta=0.4, priority=1.0, reward_priority=None, seed=None):
+        """Creates a sampler of transitions in proportion to priorities which the trainer updates, e.g. for DQfD.
 
-        for idx in range(len(reward_seq[0])):
-            # Wrap in dict
-            action_slice = [x[idx] for x in action_seq]
-            observation_slice = [x[idx] for x in observation_seq]
-            next_observation_slice = [x[idx] for x in next_observation_seq]
-            gym_spec = gym.envs.registration.spec(self.environment)
-            action_dict = DataPipeline.map_to_dict(action_slice, gym_spec._kwargs['action_space'])
-            observation_dict = DataPipeline.map_to_dict(observation_slice, gym_spec._kwargs['observation_space'])
-            next_observation_dict = DataPipeline.map_to_dict(next_observation_slice, gym_spec._kwargs['observation_space'])
+        :code:`obs, act, rew, next_obs, done, indices, weights = sampler.sample(batch_size)` samples a minibatch,
+        and :code:`sampler.update_priorities(indices, td_errors)` updates the priorities of its transitions. Both
+        take O(batch_size * log N) time over the N steps of the dataset.
 
-            yield_list = [observation_dict, action_dict, reward_seq[0][idx], next_observation_dict, done_seq[0][idx]] 
-            yield yield_list + [meta] if include_metadata else yield_list
+        Args:
+            alpha (float, optional): How much prioritization is used (0 is uniform). Defaults to 0.6.
+            beta (float, optional): The exponent of the importance sampling weights. Defaults to 0.4.
+            priority (float, optional): The initial priority of every transition. Defaults to 1.0.
+            reward_priority (float, optional): The initial priority of transitions with a non-zero reward.
+                Defaults to None (the same as every other transition).
+            seed (int, optional): The seed of the sampler. Defaults to None.
+
+        Returns:
+            PrioritizedSampler: the sampler.
+        """
+        return PrioritizedSampler(self, alpha=alpha, beta=beta, priority=priority, reward_priority=reward_priority,
+                                  seed=seed)
+
+    def _load_transitions(self, index, trajectories, steps):
+        """Loads the given steps of the trajectories of a transition index.
+
+        Returns:
+            A tuple of the batch, in the format of sample, and the positions in the request of the loaded
+            transitions (steps beyond the end of their trajectory are dropped).
+        """
+        groups, positions = [], []
+        for trajectory in np.unique(trajectories):
+            mask = np.flatnonzero(trajectories == trajectory)
+            groups.append((index.file_dirs[trajectory], steps[mask], self.environment, self._frame_cache,
+                           self.transform, self.seed, self.decoder, self.observation_keys, self.action_keys))
+            positions.append(mask)
+
+        results = self._get_pool().starmap(DataPipeline._load_steps_pyfunc, groups)
+        windows = [window for window, _ in results if window is not None]
+        if not windows:
+            raise RuntimeError("None of the sampled steps could be loaded.")
+        positions = np.concatenate([mask[valid] for mask, (_, valid) in zip(positions, results)])
+
+        # Restore the order in which the transitions were requested.
+        order = np.argsort(positions, kind='stable')
+        observation_seq, action_seq, reward_seq, next_observation_seq, done_seq = \
+            [[x[order] for x in part] for part in concatenate_windows(windows)]
+
+        return (self._observation_plan(observation_seq),
+                self._action_plan(action_seq),
+                reward_seq[0],
+                self._observation_plan(next_observation_seq),
+                done_seq[0]), positions[order]
+
+    def _get_transition_index(self):
+        if self._transition_index is None:
+            file_dirs = sorted(self._get_trajectory_dirs())
+            summaries = self._get_summaries(file_dirs)
+            self._transition_index = TransitionIndex(file_dirs, [self._num_steps(summaries[x]) for x in file_dirs])
+        return self._transition_index
+
+    def _num_steps(self, summary):
+        """The number of steps of a trajectory summary, as Trajectory counts them once the recording is indexed."""
+        if summary['num_frames'] is None or 'pov' not in self._observation_space.spaces:
+            return summary['num_steps']
+        # The leading frames without a state are skipped, and the final state has no step.
+        num_frames = min(summary['num_frames'], summary['num_steps'] + 1)
+        return max(num_frames - 1, 0)
+
+    def _batch_nbytes(self, file_dir, max_sequence_len, skip_interval=0, aggregate_actions=False, frame_stack=1):
+        """Size of the shared memory slots for the batches of max_sequence_len steps sent by the workers.
+
+        The first window of file_dir is loaded to size the arrays from their actual dtypes, after the transform
+        (which may e.g. turn uint8 frames into float32 ones). String arrays (e.g. enum actions) are as wide as the
+        longest value of their trajectory, so they are given twice their width. Falls back to an estimate from the
+        spaces, which ignores the transform, if the window can not be loaded.
+        """
+        try:
+            windows = DataPipeline._iter_windows(file_dir, max_sequence_len, self.environment, skip_interval,
+                                                 frame_cache=self._frame_cache, aggregate_actions=aggregate_actions,
+                                                 transform=self.transform, seed=self.seed, frame_stack=frame_stack,
+                                                 decoder=self.decoder, observation_keys=self.observation_keys,
+                                                 action_keys=self.action_keys)
+            try:
+                batches, _ = next(windows, (None, None))
+            finally:
+                windows.close()
+        except Exception as e:
+            logger.debug("Could not load a window of {} to size the batches: {}".format(file_dir, e))
+            batches = None
+        num_steps = len(batches[2][0]) if batches is not None else 0
+        if num_steps == 0:
+            if self.transform is not None:
+                logger.warning("Sizing the shared memory slots without the transform, batches which it enlarges are "
+                               "sent through the slower manager queue.")
+            return self._estimate_batch_nbytes(max_sequence_len, frame_stack)
+
+        arrays = []
+        _flatten(batches, arrays)
+        nbytes = sum(array.nbytes * (2 if array.dtype.kind in 'SU' else 1) + _ALIGNMENT for array in arrays)
+        # Windows at the end of short trajectories have fewer steps.
+        if num_steps < max_sequence_len:
+            nbytes = nbytes * (max_sequence_len + frame_stack) // (num_steps + frame_stack)
+        return nbytes
+
+    def _estimate_batch_nbytes(self, max_sequence_len, frame_stack=1):
+        """Upper bound on the size of the arrays of a batch of max_sequence_len steps, from the spaces."""
+        def _leaves(space):
+            if isinstance(space, spaces.Dict):
+                return [leaf for s in space.spaces.values() for leaf in _leaves(s)]
+            return [space]
+
+        def _itemsize(space):
+            if isinstance(space, spaces.Enum):
+                # Enums may be stored as their values, as fixed-width unicode strings.
+                return max(8, 4 * max((len(value) for value in space.values), default=0))
+            return np.dtype(space.dtype).itemsize if space.dtype is not None else 8
+
+        nbytes = 0
+        # The states are sent once for both the observations and the next observations.
+        for space in _leaves(self._observation_space) + _leaves(self._action_space):
+            nbytes += (max_sequence_len + 1) * _itemsize(space) * max(int(np.prod(space.shape)), 1) + _ALIGNMENT
+        # Stacked frames are sent as one block of frames, which has frame_stack - 1 more frames.
+        if 'pov' in self._observation_space.spaces:
+            nbytes += (frame_stack - 1) * int(np.prod(self._observation_space.spaces['pov'].shape))
+        # Rewards and dones.
+        return nbytes + 2 * (max_sequence_len * 8 + _ALIGNMENT)
 
     def get_trajectory_names(self):
         """Gets all the trajectory names
@@ -260,24 +719,109 @@ class DataPipeline:
         Returns:
             A list of experiment names: [description]
         """
-        return [os.path.basename(x) for x in self._get_all_valid_recordings(self.data_dir)]
+        return [os.path.basename(x) for x in self._get_trajectory_dirs()]
+
+    def get_trajectory_metadata(self):
+        """Gets the summaries of all the trajectories, without opening their recordings.
+
+        Summaries are read from the catalog kept in the data root, and are only rebuilt for
+        trajectories whose metadata.json or rendered.npz changed.
+
+        Returns:
+            A dict from trajectory names to dicts of their metadata (total_reward, duration_steps, success,
+            stream_name, ...) together with environment, num_steps, num_frames (None until the recording is
+            indexed), file_sizes ({file name: size}) and final_inventory ({item: count}).
+        """
+        summaries = self._get_summaries(self._get_all_valid_recordings(self.data_dir))
+        return {os.path.basename(file_dir): summary for file_dir, summary in summaries.items()}
+
+    def filter(self, predicate):
+        """Returns a data pipeline over only the trajectories whose summary satisfies predicate.
+
+        The predicate is evaluated on the summaries of get_trajectory_metadata before any
+        recording is opened, e.g. :code:`data.filter(lambda t: t['success'])`. It is combined
+        with this pipeline's trajectory_filter.
+
+        Args:
+            predicate (callable): A function from a trajectory summary to a bool.
+
+        Returns:
+            DataPipeline: the filtered data pipeline.
+        """
+        if self.trajectory_filter is not None:
+            trajectory_filter = functools.partial(DataPipeline._both, self.trajectory_filter, predicate)
+        else:
+            trajectory_filter = predicate
+        return self._derive(trajectory_filter=trajectory_filter)
+
+    def shard(self, rank: int, world_size: int, seed=0):
+        """Returns a data pipeline over the shard of the trajectories of one of world_size data parallel ranks.
+
+        The shards of the ranks are disjoint and balanced by their number of steps. Every epoch of
+        sarsd_iter reshuffles the trajectories and reassigns them to the ranks, deterministically
+        and identically on every rank given the same seed (see shard_trajectories), so every
+        trajectory is decoded by exactly one rank per epoch. get_trajectory_names and sample use
+        the shard of the first epoch.
+
+        Args:
+            rank (int): The rank of this trainer, in [0, world_size).
+            world_size (int): The number of data parallel trainers.
+            seed (int, optional): The seed of the shuffle, which must be the same on every rank. Defaults to 0.
+
+        Returns:
+            DataPipeline: the sharded data pipeline.
+        """
+        if not 0 <= rank < world_size:
+            raise ValueError("rank must be in [0, world_size).")
+        pipeline = self._derive()
+        pipeline._shard = (rank, world_size, seed)
+        return pipeline
+
+    def _derive(self, **kwargs):
+        """Creates a data pipeline with the same arguments as this one, except for kwargs."""
+        arguments = dict(random_seed=self.seed, use_frame_cache=self._frame_cache is not None,
+                         frame_cache_max_bytes=self._frame_cache_max_bytes,
+                         trajectory_filter=self.trajectory_filter, transform=self.transform,
+                         executor=self.executor, decoder=self.decoder,
+                         observation_keys=self.observation_keys, action_keys=self.action_keys)
+        arguments.update(kwargs)
+        pipeline = DataPipeline(self.data_dir, self.environment, self.number_of_workers, self.worker_batch_size,
+                                self.size_to_dequeue, **arguments)
+        pipeline._shard = self._shard
+        return pipeline
 
     ############################
     #     PRIVATE METHODS      #
     ############################
 
+    @property
+    def _data_root(self):
+        return os.path.dirname(os.path.normpath(self.data_dir))
+
+    @staticmethod
+    def _both(first, second, summary):
+        return first(summary) and second(summary)
+
+    def _get_summaries(self, file_dirs):
+        return Catalog(self._data_root).summaries(os.path.basename(os.path.normpath(self.data_dir)), file_dirs,
+                                                  env_str=self.environment)
+
+    def _get_trajectory_dirs(self, epoch=0):
+        file_dirs = self._get_all_valid_recordings(self.data_dir)
+        if self.trajectory_filter is None and self._shard is None:
+            return file_dirs
+        summaries = self._get_summaries(file_dirs)
+        if self.trajectory_filter is not None:
+            file_dirs = [file_dir for file_dir in file_dirs if self.trajectory_filter(summaries[file_dir])]
+        if self._shard is not None:
+            rank, world_size, seed = self._shard
+            file_dirs = shard_trajectories(file_dirs, [summaries[file_dir]['num_steps'] for file_dir in file_dirs],
+                                           rank, world_size, seed, epoch)
+        return file_dirs
+
     @staticmethod
     def read_frame(cap):
-        try:
-            ret, frame = cap.read()
-            if ret:
-                cv2.cvtColor(frame, code=cv2.COLOR_BGR2RGB, dst=frame)
-                frame = np.asarray(np.clip(frame, 0, 255), dtype=np.uint8)
-            
-            return ret, frame
-        except Exception as err:
-            logger.error("error reading capture device:", err)
-            raise err
+        return read_frame(cap)
 
     @staticmethod
     def _roundrobin(*iterables):
@@ -295,7 +839,10 @@ class DataPipeline:
 
     # Todo: Make data pipeline split files per push.
     @staticmethod
-    def _load_data_pyfunc(file_dir: str, max_seq_len: int, data_queue, env_str="", skip_interval=0, include_metadata=False):
+    def _load_data_pyfunc(file_dir: str, max_seq_len: int, data_queue, env_str="", skip_interval=0, include_metadata=False,
+                          frame_cache=None, stop_event=None, aggregate_actions=False, transform=None, seed=0,
+                          frame_stack=1, skip_windows=(), decoder='cv2', observation_keys=None, action_keys=None,
+                          resume_from=0):
         """
         Enqueueing mechanism for loading a trajectory from a file onto the data_queue
         :param file_dir: file path to data directory
@@ -303,163 +850,41 @@ class DataPipeline:
         :param max_seq_len: Number of time steps in each enqueued batch
         :param data_queue: multiprocessing data queue, or None to return streams directly
         :param include_metadata: whether or not to return an additional tuple containing metadata
-        :return:
+        :param frame_cache: FrameCache to read decoded frames from instead of the video, or None
+        :param stop_event: event set when the consumer of data_queue has stopped, or None
+        :param aggregate_actions: whether to merge the actions and rewards of the skipped steps into the kept ones
+        :param transform: transform of the observations of each window, or None
+        :param seed: seed of the random states passed to transform
+        :param frame_stack: number of frames stacked in each pov
+        :param skip_windows: starts of the windows which are not loaded (e.g. delivered before a checkpoint)
+        :param decoder: video decoder backend (see minerl.data.decoders)
+        :param observation_keys: top-level keys of the observation space to load, or None for all of them
+        :param action_keys: top-level keys of the action space to load, or None for all of them
+        :param resume_from: start of the first window to load, the earlier ones were enqueued by a previous task
+        :return: None once the trajectory is enqueued, or the start of the next window to load if the queue stayed
+            full for _HANDBACK_TIMEOUT. The worker is then handed back to the pool, so that a consumer which does
+            not keep up does not block the tasks of the other iterators, and the consumer resubmits the rest of the
+            trajectory (see _receive).
         """
         logger.debug("Loading from file {}".format(file_dir))
-        
-        video_path = str(os.path.join(file_dir, 'recording.mp4'))
-        numpy_path = str(os.path.join(file_dir, 'rendered.npz'))
-        meta_path = str(os.path.join(file_dir, 'metadata.json'))
+        if stop_event is not None and stop_event.is_set():
+            return None
 
         try:
-            # Start video decompression
-            cap = cv2.VideoCapture(video_path)
-
-            # Load numpy file
-            state = np.load(numpy_path, allow_pickle=True)
-
-            # Load metadata file
-            with open(meta_path) as file:
-                meta = json.load(file)
-                if 'stream_name' not in meta:
-                    meta['stream_name'] = file_dir
-                
-                # Hotfix for incorrect success metadata from server [TODO: remove]
-                reward_threshold = {
-                    'MineRLTreechop-v0': 64,
-                    'MineRLNavigate-v0': 100,
-                    'MineRLNavigateExtreme-v0': 100,
-                    'MineRLObtainIronPickaxe-v0': 256 + 128 + 64 + 32 + 32 + 16 + 8 + 4 + 4 + 2 + 1,
-                    'MineRLObtainDiamond-v0': 1024 + 256 + 128 + 64 + 32 + 32 + 16 + 8 + 4 + 4 + 2 + 1,
-                }
-                reward_list = {
-                    'MineRLNavigateDense-v0': [100],
-                    'MineRLNavigateExtreme-v0': [100],
-                    'MineRLObtainIronPickaxeDense-v0': [256, 128, 64, 32, 32, 16, 8, 4, 4, 2, 1],
-                    'MineRLObtainDiamondDense-v0': [1024, 256, 128, 64, 32, 32, 16, 8, 4, 4, 2, 1],
-                }
-
-
-                try:
-                    meta['success'] = meta['total_reward'] >= reward_threshold[env_str]
-                except KeyError:
-                    try:
-                        # For dense env use set of rewards (assume all disjoint rewards) within 8 of reward is good
-                        quantized_reward_vec = int(state['total_reward'] // 8)
-                        meta['success'] = all(reward//8 in quantized_reward_vec for reward in reward_list[env_str])
-                    except KeyError:
-                        logger.warning("success in metadata may be incorrect")
-
-            action_dict = collections.OrderedDict([(key, state[key]) for key in state if key.startswith('action_')])
-            reward_vec = state['reward']
-            info_dict = collections.OrderedDict([(key, state[key]) for key in state if key.startswith('observation_')])
-
-
-            # There is no action or reward for the terminal state of an episode.
-            # Hence in Publish.py we shorten the action and reward vector to reflect this.
-            # We know FOR SURE that the last video frame corresponds to the last state (from Universal.json).
-            num_states = len(reward_vec) + 1
-
-            # TEMP - calculate number of frames, fastest when max_seq_len == -1
-            ret, frame_num = True, 0
-            while ret:
-                ret, _ = DataPipeline.read_frame(cap)
-                if ret: 
-                    frame_num += 1
-                
-            max_frame_num = frame_num  # int(cap.get(cv2.CAP_PROP_FRAME_COUNT)) <- this is not correct!
-            frames = []
-            frame_num, stop_idx = 0, 0
-
-            # Advance video capture past first i-frame to start of experiment
-            cap = cv2.VideoCapture(video_path)
-            for _ in range(max_frame_num - num_states):
-                ret, _ = DataPipeline.read_frame(cap)
-                frame_num += 1
-                if not ret:
+            windows = DataPipeline._iter_windows(file_dir, max_seq_len, env_str, skip_interval, include_metadata,
+                                                 frame_cache, aggregate_actions, transform, seed, frame_stack,
+                                                 skip_windows, decoder, observation_keys, action_keys, resume_from)
+            for batches, position in windows:
+                if data_queue is None:
+                    return split_sequence(batches)
+                if stop_event is not None and stop_event.is_set():
                     return None
-
-            # Rendered Frames
-            observables = list(info_dict.keys()).copy()
-            observables.append('pov')
-            actionables = list(action_dict.keys())
-
-            # Loop through the video and construct frames
-            # of observations to be sent via the multiprocessing queue
-            # in chunks of worker_batch_size to the batch_iter loop.
-
-
-            while True:
-                ret = True
-                start_idx = stop_idx
-
-                # Collect up to worker_batch_size number of frames
-                try:
-                    # Go until max_seq_len +1 for S_t, A_t,  -> R_t, S_{t+1}, D_{t+1}
-                    while ret and frame_num < max_frame_num and (len(frames) < max_seq_len + 1 or max_seq_len == -1):
-                        ret, frame = DataPipeline.read_frame(cap)
-                        frames.append(frame)
-                        frame_num += 1
-
-                except Exception as err:
-                    logger.error("error reading capture device:", err)
-                    raise err
-
-                if len(frames) <= 1:
-                    break
-
-                if frame_num == max_frame_num:
-                    frames[-1] = frames[-2]
-
-                # Next sarsd pair index
-                stop_idx = start_idx + len(frames) - 1
-                # print('Num frames in batch:', stop_idx - start_idx)
-
-                # Load non-image data from npz
-                current_observation_data = [None for _ in observables]
-                action_data = [None for _ in actionables]
-                next_observation_data = [None for _ in observables]
-
+                # Queued windows are tagged with their position, so the consumer can checkpoint its progress.
                 try:
-                    for i, key in enumerate(observables):
-                        if key == 'pov':
-                            current_observation_data[i] = np.asanyarray(frames[:-1])
-                            next_observation_data[i] = np.asanyarray(frames[1:])
-                        elif key == 'observation_compassAngle':
-                            current_observation_data[i] = np.asanyarray(info_dict[key][start_idx:stop_idx, 0])
-                            next_observation_data[i] = np.asanyarray(info_dict[key][start_idx+1:stop_idx+1, 0])
-                        else:
-                            current_observation_data[i] = np.asanyarray(info_dict[key][start_idx:stop_idx])
-                            next_observation_data[i] = np.asanyarray(info_dict[key][start_idx+1:stop_idx+1])
-
-                    # We are getting (S_t, A_t -> R_t),   S_{t+1}, D_{t+1} so there are less actions and rewards
-                    for i, key in enumerate(actionables):
-                        
-                        action_data[i] = np.asanyarray(action_dict[key][start_idx: stop_idx])
-
-                    reward_data = np.asanyarray(reward_vec[start_idx:stop_idx], dtype=np.float32)
-
-                    done_data = [False for _ in range(len(reward_data))]
-                    if frame_num == max_frame_num:
-                        done_data[-1] = True
-                except Exception as err:
-                    logger.error("error drawing batch from npz file:", err)
-                    raise err
-
-                batches = [current_observation_data, action_data, [reward_data], next_observation_data, [np.array(done_data, dtype=np.bool)]]
-                if include_metadata:
-                    batches += [meta]
-
-                if data_queue is None:
-                    return batches
-                else:
-                    data_queue.put(batches)
-                    logger.debug("Enqueued from file {}".format(file_dir))
-
-                if not ret:
-                    break
-                else:
-                    frames = [frames[-1]]
+                    data_queue.put((batches, position), timeout=DataPipeline._HANDBACK_TIMEOUT)
+                except Full:
+                    return position[1]
+                logger.debug("Enqueued from file {}".format(file_dir))
 
             # logger.error("Finished")
             return None
@@ -475,6 +900,142 @@ class DataPipeline:
             return None
 
 
+    @staticmethod
+    def _iter_windows(file_dir, max_seq_len, env_str="", skip_interval=0, include_metadata=False, frame_cache=None,
+                      aggregate_actions=False, transform=None, seed=0, frame_stack=1, skip_windows=(), decoder='cv2',
+                      observation_keys=None, action_keys=None, resume_from=0):
+        """
+        Loads the windows of a trajectory one after another (see _load_data_pyfunc for the parameters)
+        :return: a generator of (batches in the format of Trajectory.load_sequence, (file_dir, start of the window,
+            number of windows))
+        """
+        trajectory = Trajectory(file_dir, env_str, frame_cache=frame_cache, skip_interval=skip_interval,
+                                aggregate_actions=aggregate_actions, transform=transform, seed=seed,
+                                frame_stack=frame_stack, decoder=decoder, observation_keys=observation_keys,
+                                action_keys=action_keys)
+        try:
+            meta = trajectory.metadata
+
+            # Loop through the video and construct frames
+            # of observations to be sent via the multiprocessing queue
+            # in chunks of worker_batch_size to the batch_iter loop.
+            seq_len = max_seq_len if max_seq_len != -1 else max(len(trajectory), 1)
+            starts = range(0, len(trajectory), seq_len)
+            skip_windows = set(skip_windows)
+            for start_idx in starts:
+                if start_idx in skip_windows or start_idx < resume_from:
+                    continue
+                # Go until max_seq_len +1 for S_t, A_t,  -> R_t, S_{t+1}, D_{t+1}
+                # Each state is sent once, the consumer splits it into observations and next observations.
+                batches = trajectory.load_sequence(start_idx, start_idx + seq_len)
+                if include_metadata:
+                    batches += [meta]
+                yield batches, (file_dir, start_idx, len(starts))
+        finally:
+            trajectory.close()
+
+    @staticmethod
+    def _load_data_inline(files):
+        """
+        Loads the windows of the trajectories of files in this thread, as the workers of the other executors do
+        :param files: the arguments of _load_data_pyfunc for every trajectory
+        :return: a generator of (batches, (file_dir, start of the window, number of windows))
+        """
+        for (file_dir, max_seq_len, _, env_str, skip_interval, include_metadata, frame_cache, _, aggregate_actions,
+             transform, seed, frame_stack, skip_windows, decoder, observation_keys, action_keys, resume_from) in files:
+            try:
+                yield from DataPipeline._iter_windows(file_dir, max_seq_len, env_str, skip_interval, include_metadata,
+                                                      frame_cache, aggregate_actions, transform, seed, frame_stack,
+                                                      skip_windows, decoder, observation_keys, action_keys,
+                                                      resume_from)
+            except FileNotFoundError as e:
+                raise e
+            except Exception as e:
+                logger.debug("Exception \'{}\' caught on file \"{}\" by the data pipeline.".format(e, file_dir))
+
+    def _receive(self, data_queue, files, poll_interval=1.0):
+        """Loads the trajectories of files on the worker pool, yielding the (batches, position) they put on data_queue.
+
+        At most number_of_workers trajectories of an iterator are loaded at once, and workers hand back the rest of
+        a trajectory rather than wait on a full queue (see _load_data_pyfunc), which is resubmitted here. Iterators
+        and sample() sharing the pool can thus not block each other's tasks, even when an iterator is not consumed.
+        Every finished task puts a None batch on the queue, so the consumer can wait on it without polling. Errors
+        of the tasks (e.g. a transform which can not be pickled) are raised here.
+        """
+        finished = collections.deque()
+
+        def done(args, successful, value):
+            finished.append((args, successful, value))
+            try:
+                data_queue.put_nowait((None, None))
+            except (Full, OSError, EOFError):
+                # A full queue does not block the consumer anyway.
+                pass
+
+        pool = self._get_pool()
+        pending = collections.deque(files)
+        num_running = 0
+        while pending or num_running:
+            while pending and num_running < max(self.number_of_workers, 1):
+                args = pending.popleft()
+                pool.apply_async(DataPipeline._load_data_pyfunc, args,
+                                 callback=functools.partial(done, args, True),
+                                 error_callback=functools.partial(done, args, False))
+                num_running += 1
+
+            try:
+                batches, position = data_queue.get(timeout=poll_interval)
+                if batches is not None:
+                    yield batches, position
+            except Empty:
+                pass
+
+            while finished:
+                args, successful, value = finished.popleft()
+                num_running -= 1
+                if not successful:
+                    # The task failed outside of the trajectory's loading (e.g. its arguments could not be pickled).
+                    raise value
+                if value is not None:
+                    # The rest of the trajectory was handed back, it goes before the trajectories not started yet.
+                    pending.appendleft(args[:-1] + (value,))
+
+        # The windows of the last tasks which are still queued.
+        while True:
+            try:
+                batches, position = data_queue.get_nowait()
+            except Empty:
+                break
+            if batches is not None:
+                yield batches, position
+
+    @staticmethod
+    def _load_steps_pyfunc(file_dir: str, steps, env_str="", frame_cache=None, transform=None, seed=0, decoder='cv2',
+                           observation_keys=None, action_keys=None):
+        """
+        Loads an arbitrary set of steps of a trajectory, decoding only the frames they need
+        :param file_dir: file path to data directory
+        :param steps: steps to load
+        :param frame_cache: FrameCache to read decoded frames from instead of the video, or None
+        :param transform: transform of the observations of each window, or None
+        :param seed: seed of the random states passed to transform
+        :param decoder: video decoder backend (see minerl.data.decoders)
+        :param observation_keys: top-level keys of the observation space to load, or None for all of them
+        :param action_keys: top-level keys of the action space to load, or None for all of them
+        :return: the steps which are in the trajectory in the format of Trajectory.load_window (or None if there
+            are none), and the mask of those steps
+        """
+        trajectory = Trajectory(file_dir, env_str, frame_cache=frame_cache, transform=transform, seed=seed,
+                                decoder=decoder, observation_keys=observation_keys, action_keys=action_keys)
+        try:
+            # The recording may be shorter than the number of steps the transition index was built with.
+            valid = np.asarray(steps) < len(trajectory)
+            if not valid.any():
+                return None, valid
+            return trajectory.load_steps(np.asarray(steps)[valid]), valid
+        finally:
+            trajectory.close()
+
     @staticmethod
     def _is_blacklisted(path):
         for p in [
@@ -487,27 +1048,12 @@ class DataPipeline:
 
     @staticmethod
     def _get_all_valid_recordings(path):
-        directoryList = []
-
         # return nothing if path is a file
         if os.path.isfile(path):
             return []
 
-        # Skip this file.
-        if DataPipeline._is_blacklisted(path):
-            return []
-
-        # add dir to directory list if it contains .txt files
-        if len([f for f in os.listdir(path) if f.endswith('.mp4')]) > 0:
-            if len([f for f in os.listdir(path) if f.endswith('.npz')]) > 0:
-                assert_prefix(path)
-                directoryList.append(path)
-
-        for d in os.listdir(path):
-            new_path = os.path.join(path, d)
-            if os.path.isdir(new_path):
-                directoryList += DataPipeline._get_all_valid_recordings(new_path)
-
-        directoryList = np.array(directoryList)
+        # The listing is read from the data root's catalog, which is rescanned when the directory changes.
+        data_root, environment = os.path.split(os.path.normpath(path))
+        directoryList = np.array(Catalog(data_root).file_dirs(environment))
         np.random.shuffle(directoryList)
         return directoryList.tolist()
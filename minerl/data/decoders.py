@@ -0,0 +1,294 @@
+import bisect
+import logging
+import os
+import shutil
+import subprocess
+
+import cv2
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Seeking forward only pays off over grabbing the frames in between when it skips at least this many.
+_MIN_SEEK_DISTANCE = 16
+
+
+def read_frame(cap):
+    """Reads the next frame of a capture as an RGB uint8 array.
+    """
+    try:
+        ret, frame = cap.read()
+        if ret:
+            # Captures decode to uint8 BGR, converting in place leaves nothing to clip or copy.
+            cv2.cvtColor(frame, code=cv2.COLOR_BGR2RGB, dst=frame)
+
+        return ret, frame
+    except Exception as err:
+        logger.error("error reading capture device:", err)
+        raise err
+
+
+class VideoDecoder:
+    """
+    Reads frames from a recording, continuing from the current position when possible and
+    otherwise seeking to the closest keyframe in the frame index.
+
+    Frames are decoded in place into one preallocated block per read. The latest num_kept frames
+    read are kept, so reads which go back to them are served without seeking. Backends implement
+    frame_shape, _open, which (re)starts decoding at a keyframe or any later frame, _grab,
+    which skips the next frame without converting it, _retrieve, which decodes the next frame
+    to RGB into a given array, and _release.
+    """
+
+    def __init__(self, video_path, index, num_kept=1):
+        """
+        Args:
+            video_path (str): The path of the recording.
+            index (dict): The recording's frame index (see load_frame_index).
+            num_kept (int, optional): The number of latest frames kept after each read, so that a following read
+                which starts with them (e.g. the boundary state of consecutive windows, or the history of stacked
+                frames) does not seek back. Defaults to 1.
+        """
+        self.video_path = video_path
+        self.index = index
+        self.num_kept = num_kept
+        self._opened = False
+        self._position = 0
+        # Copies of the latest frames read, by frame number.
+        self._kept = {}
+
+    @property
+    def frame_shape(self):
+        """The (height, width, 3) shape of the frames."""
+        raise NotImplementedError()
+
+    def _open(self, keyframe, frame_num):
+        """Starts decoding at keyframe or at any frame up to frame_num, returning that frame or None on failure."""
+        raise NotImplementedError()
+
+    def _grab(self):
+        """Skips the next frame, returning whether there was one."""
+        raise NotImplementedError()
+
+    def _retrieve(self, frame):
+        """Decodes the next frame into an RGB uint8 array, returning whether there was one."""
+        raise NotImplementedError()
+
+    def _release(self):
+        raise NotImplementedError()
+
+    @classmethod
+    def check_available(cls):
+        """Raises a RuntimeError if the backend can not be used, e.g. as an executable it runs is missing."""
+
+    def _seek(self, frame_num):
+        keyframes = self.index['keyframes']
+        keyframe = keyframes[bisect.bisect_right(keyframes, frame_num) - 1]
+        if not self._opened or frame_num < self._position or keyframe >= self._position + _MIN_SEEK_DISTANCE:
+            position = self._open(keyframe, frame_num)
+            if position is None:
+                return False
+            self._opened = True
+            self._position = position
+
+        while self._position < frame_num:
+            if not self._grab():
+                return False
+            self._position += 1
+        return True
+
+    def read(self, start, stop, out=None):
+        """Returns the frames [start, stop) of the recording (fewer if it ends first), see read_frames.
+        """
+        return self.read_frames(range(start, stop), out)
+
+    def read_frames(self, frame_nums, out=None):
+        """Decodes the given frames of the recording into one block of frames.
+
+        Each frame is decoded and colour converted in place in the block. The frames in between
+        are only grabbed, they are not converted to RGB. Frames behind the current position which
+        were kept from the previous read are copied rather than decoded again.
+
+        Args:
+            frame_nums (iterable): Non-decreasing frame numbers, a repeated frame is only decoded once.
+            out (np.ndarray, optional): The (len(frame_nums), height, width, 3) uint8 block to decode into.
+                Defaults to a newly allocated block.
+
+        Returns:
+            The frames read, the leading frames of the block (fewer if the recording ends first).
+        """
+        frame_nums = list(frame_nums)
+        if out is None:
+            out = np.empty((len(frame_nums),) + self.frame_shape, dtype=np.uint8)
+        num_read = 0
+        previous = None
+        for frame_num in frame_nums:
+            if frame_num == previous:
+                out[num_read] = out[num_read - 1]
+            elif frame_num < self._position and frame_num in self._kept:
+                out[num_read] = self._kept[frame_num]
+            elif not self._seek(frame_num) or not self._retrieve(out[num_read]):
+                break
+            else:
+                self._position += 1
+            previous = frame_num
+            num_read += 1
+
+        self._keep(frame_nums[:num_read], out)
+        return out[:num_read]
+
+    def _keep(self, frame_nums, frames):
+        """Keeps copies of the latest num_kept frames, out of the kept ones and those just read."""
+        read = dict(zip(frame_nums, frames))
+        latest = sorted(set(self._kept) | set(read))[-self.num_kept:] if self.num_kept > 0 else []
+        self._kept = {n: np.array(read[n]) if n in read else self._kept[n] for n in latest}
+
+    def close(self):
+        """Releases the decoder, it is reopened by the next read."""
+        if self._opened:
+            self._release()
+            self._opened = False
+
+
+class CV2Decoder(VideoDecoder):
+    """Decodes a recording with cv2.VideoCapture."""
+
+    def __init__(self, video_path, index, num_kept=1):
+        super().__init__(video_path, index, num_kept)
+        self._cap = None
+        self._shape = None
+
+    @property
+    def frame_shape(self):
+        if self._shape is None:
+            if self._cap is None:
+                self._opened, self._position = True, self._open(0, 0)
+            self._shape = (int(self._cap.get(cv2.CAP_PROP_FRAME_HEIGHT)),
+                           int(self._cap.get(cv2.CAP_PROP_FRAME_WIDTH)),
+                           3)
+        return self._shape
+
+    def _open(self, keyframe, frame_num):
+        if self._cap is None or keyframe == 0:
+            self._release()
+            self._cap = cv2.VideoCapture(self.video_path)
+        if keyframe > 0 and not self._cap.set(cv2.CAP_PROP_POS_FRAMES, keyframe):
+            return None
+        return keyframe
+
+    def _grab(self):
+        return self._cap.grab()
+
+    def _retrieve(self, frame):
+        ret, image = self._cap.read(image=frame)
+        if not ret:
+            return False
+        if image.ctypes.data != frame.ctypes.data:
+            # The capture could not decode into the frame (e.g. as the recording has another size).
+            frame[...] = image
+        cv2.cvtColor(frame, code=cv2.COLOR_BGR2RGB, dst=frame)
+        return True
+
+    def _release(self):
+        if self._cap is not None:
+            self._cap.release()
+            self._cap = None
+
+
+class FFmpegDecoder(VideoDecoder):
+    """
+    Decodes a recording with an ffmpeg subprocess which pipes raw RGB24 frames, read directly
+    into the block of frames. ffmpeg seeks to any frame itself (decoding from the keyframe before
+    it), so only the frames which are read cross the pipe.
+
+    Requires the ffmpeg executable, found on the PATH or given by the MINERL_FFMPEG environment
+    variable. Assumes a constant frame rate, as in the MineRL recordings.
+    """
+
+    def __init__(self, video_path, index, num_kept=1):
+        super().__init__(video_path, index, num_kept)
+        self.executable = self.check_available()
+
+        # Only the header is read to find the size and frame rate.
+        cap = cv2.VideoCapture(video_path)
+        try:
+            self._shape = (int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT)), int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)), 3)
+            self.fps = cap.get(cv2.CAP_PROP_FPS)
+        finally:
+            cap.release()
+        self._process = None
+        self._scratch = np.empty(self._shape, dtype=np.uint8)
+
+    @classmethod
+    def check_available(cls):
+        """Returns the path of the ffmpeg executable, raising a RuntimeError if it is not found."""
+        executable = os.environ.get('MINERL_FFMPEG') or shutil.which('ffmpeg')
+        if executable is None or shutil.which(executable) is None:
+            raise RuntimeError("The ffmpeg decoder requires ffmpeg, install it or set MINERL_FFMPEG.")
+        return executable
+
+    @property
+    def frame_shape(self):
+        return self._shape
+
+    def _open(self, keyframe, frame_num):
+        self._release()
+        command = [self.executable, '-nostdin', '-loglevel', 'error']
+        if frame_num > 0:
+            if not self.fps > 0:
+                return None
+            # Half a frame early, so that rounding of the timestamps does not skip frame_num.
+            command += ['-ss', '{:.6f}'.format((frame_num - 0.5) / self.fps)]
+        command += ['-i', self.video_path, '-an', '-f', 'rawvideo', '-pix_fmt', 'rgb24', '-vsync', '0', '-']
+        try:
+            self._process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        except OSError as e:
+            logger.warning("Could not start ffmpeg on {}: {}".format(self.video_path, e))
+            return None
+        return frame_num
+
+    def _read_into(self, frame):
+        view = memoryview(frame).cast('B')
+        filled = 0
+        while filled < len(view):
+            n = self._process.stdout.readinto(view[filled:])
+            if not n:
+                return False
+            filled += n
+        return True
+
+    def _grab(self):
+        return self._read_into(self._scratch)
+
+    def _retrieve(self, frame):
+        return self._read_into(frame)
+
+    def _release(self):
+        if self._process is not None:
+            self._process.stdout.close()
+            self._process.kill()
+            self._process.wait()
+            self._process = None
+
+
+# The decoder backends which can be selected by name.
+DECODERS = {
+    'cv2': CV2Decoder,
+    'ffmpeg': FFmpegDecoder,
+}
+
+
+def get_decoder(decoder):
+    """Returns the VideoDecoder class of a backend.
+
+    Args:
+        decoder (str or type): The name of a backend in DECODERS, or a VideoDecoder subclass.
+
+    Returns:
+        The VideoDecoder subclass.
+    """
+    if isinstance(decoder, str):
+        if decoder not in DECODERS:
+            raise ValueError("decoder must be one of {} or a VideoDecoder.".format(", ".join(DECODERS)))
+        return DECODERS[decoder]
+    return decoder
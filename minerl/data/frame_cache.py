@@ -0,0 +1,205 @@
+import logging
+import multiprocessing
+import os
+import threading
+
+import numpy as np
+
+from minerl.data.decoders import get_decoder
+from minerl.data.frame_index import load_frame_index
+
+logger = logging.getLogger(__name__)
+
+FRAME_CACHE_FILE_NAME = 'recording.npy'
+
+
+class FrameCache:
+    """
+    A store of decoded POV frames kept next to each trajectory's rendered.npz.
+
+    Each trajectory's recording.mp4 is decoded once into a flat uint8 (T, H, W, 3) .npy file
+    holding the frames aligned with the states in rendered.npz, which is then read through
+    np.memmap. When max_bytes is set, whole trajectories are evicted least recently used first
+    to keep the total size of the store under the cap. Recordings are decoded with the given
+    decoder backend (see minerl.data.decoders).
+    """
+
+    # Number of frames decoded into the store at a time.
+    _BUILD_WINDOW = 256
+
+    def __init__(self, data_root: str, max_bytes: int = None, decoder='cv2'):
+        """
+        Args:
+            data_root (str): The directory under which all cached trajectories are accounted for.
+            max_bytes (int, optional): The maximum total size of the cached frames. Defaults to None (unlimited).
+            decoder (str or type, optional): The video decoder backend, a name in minerl.data.decoders.DECODERS or a
+                VideoDecoder subclass. Defaults to 'cv2'.
+        """
+        self.data_root = data_root
+        self.max_bytes = max_bytes
+        self.decoder = decoder
+
+    @staticmethod
+    def path(file_dir):
+        return os.path.join(file_dir, FRAME_CACHE_FILE_NAME)
+
+    def get(self, file_dir):
+        """Returns the cached frames of a trajectory as a read-only memmap, or None if they are not cached.
+        """
+        path = self.path(file_dir)
+        try:
+            frames = np.load(path, mmap_mode='r')
+        except (OSError, ValueError):
+            return None
+
+        # Mark the trajectory as recently used.
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return frames
+
+    def get_or_build(self, file_dir, num_states=None):
+        """Returns the cached frames of a trajectory, decoding them into the store on a miss.
+
+        Returns:
+            A read-only memmap of shape (T, H, W, 3), or None if the trajectory could not be cached.
+        """
+        frames = self.get(file_dir)
+        if frames is None and self.build(file_dir, num_states):
+            frames = self.get(file_dir)
+        return frames
+
+    def build(self, file_dir, num_states=None):
+        """Decodes a trajectory's recording into the store, evicting other trajectories if needed.
+
+        Args:
+            file_dir (str): The trajectory directory containing recording.mp4 and rendered.npz.
+            num_states (int, optional): The number of states in rendered.npz. Read from the npz when None.
+
+        Returns:
+            True if the trajectory is in the store.
+        """
+        path = self.path(file_dir)
+        if os.path.exists(path):
+            return True
+
+        if num_states is None:
+            num_states = len(np.load(os.path.join(file_dir, 'rendered.npz'), allow_pickle=True)['reward']) + 1
+
+        index = load_frame_index(file_dir, num_states)
+        reader = get_decoder(self.decoder)(os.path.join(file_dir, 'recording.mp4'), index)
+        try:
+            shape = (index['num_frames'] - index['offset'],) + reader.frame_shape
+            size = int(np.prod(shape))
+            if self.max_bytes is not None and size > self.max_bytes:
+                logger.debug("Trajectory {} is larger than the frame cache.".format(file_dir))
+                return False
+
+            self.evict(self.max_bytes - size if self.max_bytes is not None else None)
+
+            tmp_path = '{}.{}.{}.tmp.npy'.format(path[:-len('.npy')], os.getpid(), threading.get_ident())
+            try:
+                frames = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.uint8, shape=shape)
+                for start in range(0, shape[0], self._BUILD_WINDOW):
+                    stop = min(start + self._BUILD_WINDOW, shape[0])
+                    num_read = len(reader.read(index['offset'] + start, index['offset'] + stop,
+                                               out=np.asarray(frames[start:stop])))
+                    if num_read < stop - start:
+                        raise RuntimeError("Recording {} ended before frame {}".format(file_dir, start + num_read))
+                frames.flush()
+                del frames
+                os.replace(tmp_path, path)
+            except (OSError, RuntimeError) as e:
+                logger.warning("Could not cache the frames of {}: {}".format(file_dir, e))
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+                return False
+        finally:
+            reader.close()
+
+        logger.debug("Cached frames of {}".format(file_dir))
+        return True
+
+    def evict(self, max_bytes=None):
+        """Removes least recently used trajectories until the store is no larger than max_bytes.
+
+        Args:
+            max_bytes (int, optional): The size to shrink the store to. Defaults to the store's cap.
+        """
+        max_bytes = self.max_bytes if max_bytes is None else max_bytes
+        if max_bytes is None:
+            return
+
+        entries = []
+        for path in self.cached_files():
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError as e:
+                logger.debug("Could not evict cached frames {}: {}".format(path, e))
+                continue
+            logger.debug("Evicted cached frames {}".format(path))
+            total -= size
+
+    def cached_files(self):
+        """Returns the paths of all cached frame files under the data root.
+        """
+        return [os.path.join(dirpath, FRAME_CACHE_FILE_NAME)
+                for dirpath, _, filenames in os.walk(self.data_root)
+                if FRAME_CACHE_FILE_NAME in filenames]
+
+    def size(self):
+        """Returns the total size in bytes of the cached frames.
+        """
+        return sum(os.path.getsize(p) for p in self.cached_files())
+
+
+def _build_one(cache, file_dir):
+    return cache.build(file_dir)
+
+
+def build_frame_cache(data_dir, environment=None, max_bytes=None, num_workers=4, decoder='cv2'):
+    """Decodes the recordings of the MineRL dataset into a memory-mapped frame cache.
+
+    Trajectories are decoded in random order; once max_bytes is reached, the least recently
+    used trajectories are evicted to make room.
+
+    Args:
+        data_dir (str): The MineRL data root.
+        environment (str or list, optional): The environment(s) to cache. Defaults to all environments.
+        max_bytes (int, optional): The maximum total size of the cache. Defaults to None (unlimited).
+        num_workers (int, optional): The number of recordings to decode at once. Defaults to 4.
+        decoder (str or type, optional): The video decoder backend (see FrameCache). Defaults to 'cv2'.
+
+    Returns:
+        FrameCache: the cache, for use with DataPipeline.
+    """
+    from minerl.data.data_pipeline import DataPipeline
+
+    if environment is None:
+        environments = [d for d in os.listdir(data_dir) if os.path.isdir(os.path.join(data_dir, d))]
+    elif isinstance(environment, str):
+        environments = [environment]
+    else:
+        environments = list(environment)
+
+    cache = FrameCache(data_dir, max_bytes, decoder)
+    file_dirs = []
+    for env in environments:
+        file_dirs += DataPipeline._get_all_valid_recordings(os.path.join(data_dir, env))
+
+    with multiprocessing.Pool(num_workers) as pool:
+        built = pool.starmap(_build_one, [(cache, file_dir) for file_dir in file_dirs])
+
+    logger.info("Cached {} of {} trajectories ({} bytes).".format(sum(built), len(file_dirs), cache.size()))
+    return cache
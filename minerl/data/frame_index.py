@@ -0,0 +1,215 @@
+import hashlib
+import json
+import logging
+import os
+import struct
+import threading
+
+import cv2
+
+logger = logging.getLogger(__name__)
+
+FRAME_INDEX_FILE_NAME = 'frame_index.json'
+FRAME_INDEX_VERSION = 1
+
+# Spacing of candidate seek points when the container does not list its sync samples.
+_DEFAULT_KEYFRAME_SPACING = 32
+
+
+def load_frame_index(file_dir, num_states, build=True):
+    """Loads the frame index of a trajectory's recording, building it if needed.
+
+    The index records the true number of decodable frames in recording.mp4, the alignment
+    offset between the video and rendered.npz (the leading frames which have no state) and
+    the frames which can be seeked to directly.
+
+    The index is stored next to the recording, or in the user cache directory (see
+    frame_index_cache_dir) when the data root can not be written to.
+
+    Args:
+        file_dir (str): The trajectory directory containing recording.mp4.
+        num_states (int): The number of states in rendered.npz (len(reward) + 1).
+        build (bool, optional): Whether or not to build the index when it is missing or stale.
+            Defaults to True.
+
+    Returns:
+        The index as a dict, or None if it is missing and build is False.
+    """
+    video_path = os.path.join(file_dir, 'recording.mp4')
+    stat = os.stat(video_path)
+    index_paths = _index_paths(video_path)
+
+    for index_path in index_paths:
+        try:
+            with open(index_path) as f:
+                index = json.load(f)
+            if (index.get('version') == FRAME_INDEX_VERSION
+                    and index['video_size'] == stat.st_size
+                    and index['video_mtime'] == stat.st_mtime
+                    and index['num_states'] == num_states):
+                return index
+        except (OSError, ValueError, KeyError):
+            pass
+
+    if not build:
+        return None
+
+    index = build_frame_index(file_dir, num_states)
+    for index_path in index_paths:
+        try:
+            os.makedirs(os.path.dirname(index_path), exist_ok=True)
+            tmp_path = '{}.{}.{}.tmp'.format(index_path, os.getpid(), threading.get_ident())
+            with open(tmp_path, 'w') as f:
+                json.dump(index, f)
+            os.replace(tmp_path, index_path)
+            break
+        except OSError as e:
+            logger.debug("Could not write frame index {} for {}: {}".format(index_path, file_dir, e))
+    else:
+        logger.warning("Could not store the frame index of {}, it will be rebuilt on every load.".format(file_dir))
+    return index
+
+
+def frame_index_cache_dir():
+    """Returns the directory of the frame indexes of recordings whose directory can not be written to.
+
+    It is $MINERL_CACHE_DIR/frame_index, by default under $XDG_CACHE_HOME (~/.cache/minerl).
+    """
+    cache_dir = os.environ.get('MINERL_CACHE_DIR')
+    if not cache_dir:
+        cache_dir = os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.join('~', '.cache'), 'minerl')
+    return os.path.join(os.path.expanduser(cache_dir), 'frame_index')
+
+
+def _index_paths(video_path):
+    """The paths at which the frame index of a recording is looked for, in order: next to it, then in the cache."""
+    real_path = os.path.realpath(video_path)
+    name = hashlib.md5(real_path.encode()).hexdigest() + '.json'
+    return [os.path.join(os.path.dirname(video_path), FRAME_INDEX_FILE_NAME),
+            os.path.join(frame_index_cache_dir(), name)]
+
+
+def build_frame_index(file_dir, num_states):
+    """Decodes a trajectory's recording once to build its frame index.
+
+    Frames are only grabbed (not colour converted) while counting. Candidate keyframes are
+    taken from the mp4 sync sample table and are only kept if seeking to them yields exactly
+    the frame produced by sequential decoding.
+
+    Args:
+        file_dir (str): The trajectory directory containing recording.mp4.
+        num_states (int): The number of states in rendered.npz (len(reward) + 1).
+
+    Returns:
+        The index as a dict.
+    """
+    video_path = os.path.join(file_dir, 'recording.mp4')
+    stat = os.stat(video_path)
+    logger.debug("Building frame index for {}".format(file_dir))
+
+    sync_samples = _read_mp4_sync_samples(video_path)
+    candidates = set(sync_samples) if sync_samples is not None else None
+
+    # Count the frames, retrieving only those which are candidate keyframes.
+    digests = {}
+    cap = cv2.VideoCapture(video_path)
+    num_frames = 0
+    try:
+        while cap.grab():
+            if num_frames > 0 and (num_frames in candidates if candidates is not None
+                                   else num_frames % _DEFAULT_KEYFRAME_SPACING == 0):
+                ret, frame = cap.retrieve()
+                if ret:
+                    digests[num_frames] = hashlib.md5(frame.tobytes()).hexdigest()
+            num_frames += 1
+    finally:
+        cap.release()
+
+    # Keep only the keyframes which decode identically when seeked to.
+    keyframes = [0]
+    if digests:
+        cap = cv2.VideoCapture(video_path)
+        try:
+            for frame_num in sorted(digests):
+                if not cap.set(cv2.CAP_PROP_POS_FRAMES, frame_num):
+                    break
+                ret, frame = cap.read()
+                if ret and hashlib.md5(frame.tobytes()).hexdigest() == digests[frame_num]:
+                    keyframes.append(frame_num)
+        finally:
+            cap.release()
+
+    return {
+        'version': FRAME_INDEX_VERSION,
+        'num_frames': num_frames,
+        'num_states': num_states,
+        'offset': max(num_frames - num_states, 0),
+        'keyframes': keyframes,
+        'video_size': stat.st_size,
+        'video_mtime': stat.st_mtime,
+    }
+
+
+def _read_mp4_sync_samples(path):
+    """Reads the (zero based) sync sample numbers of the first video track in an mp4 file.
+
+    Returns:
+        A sorted list of frame numbers, or None if the file does not list sync samples.
+    """
+    try:
+        with open(path, 'rb') as f:
+            f.seek(0, os.SEEK_END)
+            return _find_sync_samples(f, 0, f.tell())
+    except (OSError, struct.error, ValueError) as e:
+        logger.debug("Could not read mp4 sync samples from {}: {}".format(path, e))
+        return None
+
+
+def _iter_boxes(f, start, end):
+    pos = start
+    while pos + 8 <= end:
+        f.seek(pos)
+        size, box_type = struct.unpack('>I4s', f.read(8))
+        header = 8
+        if size == 1:
+            size = struct.unpack('>Q', f.read(8))[0]
+            header = 16
+        elif size == 0:
+            size = end - pos
+        if size < header:
+            raise ValueError("Malformed mp4 box")
+        yield box_type, pos + header, pos + size
+        pos += size
+
+
+def _find_sync_samples(f, start, end):
+    for box_type, box_start, box_end in _iter_boxes(f, start, end):
+        if box_type in (b'moov', b'trak'):
+            samples = _find_sync_samples(f, box_start, box_end)
+            if samples is not None:
+                return samples
+        elif box_type == b'mdia' and _has_video_handler(f, box_start, box_end):
+            return _find_stss(f, box_start, box_end)
+    return None
+
+
+def _find_stss(f, start, end):
+    for box_type, box_start, box_end in _iter_boxes(f, start, end):
+        if box_type in (b'minf', b'stbl'):
+            samples = _find_stss(f, box_start, box_end)
+            if samples is not None:
+                return samples
+        elif box_type == b'stss':
+            f.seek(box_start + 4)
+            count = struct.unpack('>I', f.read(4))[0]
+            entries = struct.unpack('>{}I'.format(count), f.read(4 * count))
+            return sorted(e - 1 for e in entries)
+    return None
+
+
+def _has_video_handler(f, start, end):
+    for box_type, box_start, _ in _iter_boxes(f, start, end):
+        if box_type == b'hdlr':
+            f.seek(box_start + 8)
+            return f.read(4) == b'vide'
+    return False
@@ -0,0 +1,68 @@
+import struct
+import zipfile
+
+import numpy as np
+
+# Size of a zip local file header, before the file name and the extra field.
+_LOCAL_HEADER_SIZE = 30
+
+
+class NpzReader:
+    """
+    Lazy access to the arrays of an npz file (e.g. a trajectory's rendered.npz).
+
+    Arrays are only read when they are first accessed. Uncompressed members of a numeric dtype
+    are memory-mapped, so indexing them only reads the requested steps from disk; compressed
+    members and pickled (object) arrays are loaded whole as by np.load.
+    """
+
+    def __init__(self, path):
+        """
+        Args:
+            path (str): The path of the npz file.
+        """
+        self.path = path
+        self._npz = np.load(path, allow_pickle=True)
+        self._stored = {info.filename[:-len('.npy')]: info for info in self._npz.zip.infolist()
+                        if info.compress_type == zipfile.ZIP_STORED and info.filename.endswith('.npy')}
+        self._arrays = {}
+
+    def keys(self):
+        return list(self._npz.files)
+
+    def __iter__(self):
+        return iter(self._npz.files)
+
+    def __contains__(self, key):
+        return key in self._npz.files
+
+    def __getitem__(self, key):
+        if key not in self._arrays:
+            array = self._memmap(key) if key in self._stored else None
+            self._arrays[key] = array if array is not None else self._npz[key]
+        return self._arrays[key]
+
+    def _memmap(self, key):
+        """Memory-maps an uncompressed member, or returns None if it can not be (e.g. an object or empty array)."""
+        info = self._stored[key]
+        with open(self.path, 'rb') as f:
+            f.seek(info.header_offset)
+            header = f.read(_LOCAL_HEADER_SIZE)
+            name_length, extra_length = struct.unpack('<HH', header[26:30])
+            f.seek(info.header_offset + _LOCAL_HEADER_SIZE + name_length + extra_length)
+            version = np.lib.format.read_magic(f)
+            if version == (1, 0):
+                shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+            elif version == (2, 0):
+                shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+            else:
+                return None
+            offset = f.tell()
+        if dtype.hasobject or len(shape) == 0 or int(np.prod(shape)) == 0:
+            return None
+        return np.memmap(self.path, dtype=dtype, mode='r', offset=offset, shape=shape,
+                         order='F' if fortran_order else 'C')
+
+    def close(self):
+        self._arrays = {}
+        self._npz.close()
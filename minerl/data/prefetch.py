@@ -0,0 +1,71 @@
+import queue
+import threading
+
+# Marks the end of the items in the ready queue.
+_END = object()
+
+
+class _Failure:
+    __slots__ = ['error']
+
+    def __init__(self, error):
+        self.error = error
+
+
+def prefetch(items, depth):
+    """Iterates over items in a background thread which keeps up to depth items ready ahead of the consumer.
+
+    The consumer blocks on the ready queue until the thread has produced the next item. When the
+    returned generator is closed, the thread stops after the item it is producing and closes items
+    itself (a generator can only be closed by the thread running it). Exceptions raised by items
+    are re-raised to the consumer.
+
+    Args:
+        items (iterable): The items to prefetch, e.g. the sequences of DataPipeline.sarsd_iter.
+        depth (int): The maximum number of items ready ahead of the consumer. 0 iterates over items
+            in the consumer's thread.
+
+    Yields:
+        The items, in order.
+    """
+    if depth <= 0:
+        yield from items
+        return
+
+    ready = queue.Queue(maxsize=depth)
+    stopped = threading.Event()
+
+    def _run():
+        try:
+            for item in items:
+                # The consumer drains the ready queue once after stopping, so this put can not block forever.
+                if stopped.is_set():
+                    break
+                ready.put(item)
+                del item
+            else:
+                ready.put(_END)
+        except Exception as e:
+            ready.put(_Failure(e))
+        finally:
+            close = getattr(items, 'close', None)
+            if close is not None:
+                close()
+
+    threading.Thread(target=_run, name='minerl-prefetch', daemon=True).start()
+    try:
+        while True:
+            item = ready.get()
+            if item is _END:
+                return
+            if isinstance(item, _Failure):
+                raise item.error
+            yield item
+            del item
+    finally:
+        stopped.set()
+        try:
+            while True:
+                ready.get_nowait()
+        except queue.Empty:
+            pass
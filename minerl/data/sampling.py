@@ -0,0 +1,223 @@
+import logging
+import os
+
+import numpy as np
+
+from minerl.data.npz_reader import NpzReader
+
+logger = logging.getLogger(__name__)
+
+
+class TransitionIndex:
+    """
+    A compact index over every (trajectory, step) pair of a set of trajectories.
+
+    Only the number of steps of each trajectory and their cumulative offsets are stored, so a
+    global step number in [0, len(index)) maps to a trajectory and a step with a binary search.
+    """
+
+    def __init__(self, file_dirs, lengths):
+        """
+        Args:
+            file_dirs (list): The trajectory directories.
+            lengths (array-like): The number of steps of each trajectory.
+        """
+        self.file_dirs = list(file_dirs)
+        self.lengths = np.asarray(lengths, dtype=np.int64)
+        self.offsets = np.concatenate([[0], np.cumsum(self.lengths)])
+
+    def __len__(self):
+        return int(self.offsets[-1])
+
+    def locate(self, indices):
+        """Maps global step numbers to trajectory numbers and steps within those trajectories.
+
+        Args:
+            indices (array-like): Global step numbers in [0, len(self)).
+
+        Returns:
+            A tuple of (trajectory numbers, steps) arrays.
+        """
+        indices = np.asarray(indices, dtype=np.int64)
+        trajectories = np.searchsorted(self.offsets, indices, side='right') - 1
+        return trajectories, indices - self.offsets[trajectories]
+
+    def global_index(self, trajectories, steps):
+        """Maps trajectory numbers and steps to global step numbers (the inverse of locate).
+        """
+        return self.offsets[np.asarray(trajectories, dtype=np.int64)] + np.asarray(steps, dtype=np.int64)
+
+
+def shard_trajectories(file_dirs, lengths, rank, world_size, seed=0, epoch=0):
+    """Assigns trajectories to world_size ranks with balanced numbers of steps.
+
+    The trajectories are shuffled with a random state seeded by (seed, epoch), and each of
+    them is assigned in turn to the rank with the fewest steps so far. The assignment only
+    depends on the trajectory names, their lengths, seed and epoch, so every rank computes
+    the same one; the ranks' shards are disjoint and differ in steps by at most the length of
+    the longest trajectory.
+
+    Args:
+        file_dirs (list): The trajectory directories.
+        lengths (list): The number of steps of each trajectory.
+        rank (int): The rank whose shard is returned, in [0, world_size).
+        world_size (int): The number of ranks.
+        seed (int, optional): The seed shared by every rank. Defaults to 0.
+        epoch (int, optional): The epoch, the trajectories are reshuffled every epoch. Defaults to 0.
+
+    Returns:
+        The trajectory directories of the rank's shard, in shuffled order.
+    """
+    order = sorted(range(len(file_dirs)), key=lambda i: os.path.basename(os.path.normpath(file_dirs[i])))
+    permutation = np.random.RandomState([seed, epoch]).permutation(len(order))
+
+    loads = np.zeros(world_size, dtype=np.int64)
+    shard = []
+    for i in permutation:
+        trajectory = order[i]
+        target = int(np.argmin(loads))
+        loads[target] += lengths[trajectory]
+        if target == rank:
+            shard.append(file_dirs[trajectory])
+    return shard
+
+
+class SumTree:
+    """
+    A binary tree over capacity priorities whose inner nodes hold the sum of their children.
+
+    The tree is stored in one array, with the root at 1 and the children of node i at 2i and
+    2i + 1. Updating priorities and finding the leaves at given prefix sums both take
+    O(log capacity) per element and are vectorized over batches.
+    """
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.depth = max(int(np.ceil(np.log2(max(capacity, 1)))), 0)
+        self._leaf_offset = 2 ** self.depth
+        self._tree = np.zeros(2 * self._leaf_offset, dtype=np.float64)
+
+    @property
+    def total(self):
+        return float(self._tree[1])
+
+    def __getitem__(self, indices):
+        return self._tree[self._leaf_offset + np.asarray(indices, dtype=np.int64)]
+
+    def update(self, indices, priorities):
+        """Sets the priorities of leaves (the last one wins for repeated indices).
+
+        Args:
+            indices (array-like): Leaf indices in [0, capacity).
+            priorities (array-like): Non-negative priorities.
+        """
+        nodes = self._leaf_offset + np.asarray(indices, dtype=np.int64)
+        self._tree[nodes] = priorities
+        for _ in range(self.depth):
+            nodes = np.unique(nodes // 2)
+            self._tree[nodes] = self._tree[2 * nodes] + self._tree[2 * nodes + 1]
+
+    def find(self, values):
+        """Finds the leaves at which the prefix sums of the priorities reach values.
+
+        Args:
+            values (array-like): Prefix sums in [0, total).
+
+        Returns:
+            The leaf indices.
+        """
+        values = np.array(values, dtype=np.float64)
+        nodes = np.ones(len(values), dtype=np.int64)
+        for _ in range(self.depth):
+            left = 2 * nodes
+            right = values >= self._tree[left]
+            values -= np.where(right, self._tree[left], 0)
+            nodes = left + right
+        return np.minimum(nodes - self._leaf_offset, self.capacity - 1)
+
+
+class PrioritizedSampler:
+    """
+    Samples minibatches of transitions of a data pipeline in proportion to their priorities.
+
+    Priorities live in a SumTree over the global step numbers of a TransitionIndex, and can be
+    updated by the trainer after each minibatch (e.g. with the TD error or behavioural cloning
+    loss of the sampled transitions). As in prioritized experience replay, a transition with
+    priority p is sampled with probability p ** alpha / sum(p ** alpha), and importance sampling
+    weights (N * P(i)) ** -beta, normalized by their maximum in the minibatch, are returned.
+    """
+
+    def __init__(self, data_pipeline, alpha=0.6, beta=0.4, priority=1.0, reward_priority=None, seed=None):
+        """
+        Args:
+            data_pipeline (DataPipeline): The data pipeline whose transitions are sampled.
+            alpha (float, optional): How much prioritization is used (0 is uniform). Defaults to 0.6.
+            beta (float, optional): The exponent of the importance sampling weights. Defaults to 0.4.
+            priority (float, optional): The initial priority of every transition. Defaults to 1.0.
+            reward_priority (float, optional): The initial priority of transitions with a non-zero reward in
+                rendered.npz. Defaults to None (the same as every other transition).
+            seed (int, optional): The seed of the sampler's random state. Defaults to None.
+        """
+        self.data_pipeline = data_pipeline
+        self.alpha = alpha
+        self.beta = beta
+        self.index = data_pipeline._get_transition_index()
+        self.tree = SumTree(len(self.index))
+        self._rng = np.random.RandomState(seed)
+
+        priorities = np.full(len(self.index), priority, dtype=np.float64)
+        if reward_priority is not None:
+            for trajectory, file_dir in enumerate(self.index.file_dirs):
+                # Only the rewards are read, memory-mapped if the npz is uncompressed.
+                state = NpzReader(os.path.join(file_dir, 'rendered.npz'))
+                try:
+                    # The transition index may be shorter than the npz if the recording ends early.
+                    reward = state['reward'][:self.index.lengths[trajectory]]
+                    priorities[self.index.offsets[trajectory] + np.flatnonzero(reward)] = reward_priority
+                finally:
+                    state.close()
+        self.tree.update(np.arange(len(self.index)), priorities ** self.alpha)
+
+    def __len__(self):
+        return len(self.index)
+
+    def sample_indices(self, batch_size: int):
+        """Samples global step numbers in proportion to their priorities, with one sample per equal slice of
+        the total priority.
+
+        Returns:
+            A tuple of (global step numbers, importance sampling weights).
+        """
+        total = self.tree.total
+        bounds = np.arange(batch_size + 1) * (total / batch_size)
+        values = self._rng.uniform(bounds[:-1], bounds[1:])
+        indices = self.tree.find(np.minimum(values, np.nextafter(total, 0)))
+
+        probabilities = self.tree[indices] / total
+        weights = (len(self) * np.maximum(probabilities, np.finfo(np.float64).tiny)) ** -self.beta
+        return indices, (weights / weights.max()).astype(np.float32)
+
+    def sample(self, batch_size: int):
+        """Samples a minibatch of transitions in proportion to their priorities.
+
+        Args:
+            batch_size (int): The number of transitions to sample.
+
+        Returns:
+            A tuple of (state, player_action, reward_from_action, next_state, is_next_state_terminal, indices,
+            weights) in the format of DataPipeline.sample, with the global step numbers of the transitions (to
+            update their priorities with) and their importance sampling weights.
+        """
+        indices, weights = self.sample_indices(batch_size)
+        trajectories, steps = self.index.locate(indices)
+        batch, loaded = self.data_pipeline._load_transitions(self.index, trajectories, steps)
+        return batch + (indices[loaded], weights[loaded])
+
+    def update_priorities(self, indices, priorities):
+        """Updates the priorities of transitions, e.g. with the absolute TD errors of a sampled minibatch.
+
+        Args:
+            indices (array-like): The global step numbers returned by sample.
+            priorities (array-like): The new (positive) priorities.
+        """
+        self.tree.update(indices, np.asarray(priorities, dtype=np.float64) ** self.alpha)
@@ -0,0 +1,234 @@
+import logging
+import queue
+import weakref
+
+import numpy as np
+
+try:
+    from multiprocessing import shared_memory
+except ImportError:  # Python < 3.8
+    shared_memory = None
+
+logger = logging.getLogger(__name__)
+
+# Closed queues' blocks which still had views exported; they are closed once the views are collected.
+_orphaned_blocks = []
+
+_ALIGNMENT = 64
+
+# Names of the queues which already warned this process of a batch too large for their slots.
+_warned_queues = set()
+
+
+class _ArrayRef:
+    __slots__ = ['index']
+
+    def __init__(self, index):
+        self.index = index
+
+
+class _ViewRef(_ArrayRef):
+    __slots__ = ['offset', 'shape', 'strides']
+
+    def __init__(self, index, offset, shape, strides):
+        super().__init__(index)
+        self.offset = offset
+        self.shape = shape
+        self.strides = strides
+
+
+def _overlapping_base(array):
+    """Returns the contiguous base of a view which is larger than its base (e.g. stacked frames) and the
+    offset of the view into it, or None."""
+    base = array.base
+    if (array.flags.c_contiguous or not isinstance(base, np.ndarray) or not base.flags.c_contiguous
+            or base.dtype != array.dtype or base.nbytes >= array.nbytes or min(array.strides) < 0):
+        return None
+    offset = array.__array_interface__['data'][0] - base.__array_interface__['data'][0]
+    extent = offset + sum((n - 1) * stride for n, stride in zip(array.shape, array.strides)) + array.itemsize
+    if offset < 0 or extent > base.nbytes:
+        return None
+    return base, offset
+
+
+def _flatten(item, arrays, bases=None):
+    """Replaces every (non object) array of a nested list batch with an _ArrayRef into arrays.
+
+    Views which overlap themselves are replaced with a _ViewRef into their base, which is only
+    added to arrays once.
+    """
+    if bases is None:
+        bases = {}
+    if isinstance(item, (list, tuple)):
+        return type(item)(_flatten(x, arrays, bases) for x in item)
+    if isinstance(item, np.ndarray) and item.dtype != np.object_:
+        view = _overlapping_base(item) if item.size > 0 else None
+        if view is not None:
+            base, offset = view
+            if id(base) not in bases:
+                arrays.append(base)
+                bases[id(base)] = len(arrays) - 1
+            return _ViewRef(bases[id(base)], offset, item.shape, item.strides)
+        arrays.append(item)
+        return _ArrayRef(len(arrays) - 1)
+    return item
+
+
+def _unflatten(item, arrays):
+    if isinstance(item, (list, tuple)):
+        return type(item)(_unflatten(x, arrays) for x in item)
+    if isinstance(item, _ViewRef):
+        base = arrays[item.index]
+        return np.ndarray(item.shape, base.dtype, buffer=base, offset=item.offset, strides=item.strides)
+    if isinstance(item, _ArrayRef):
+        return arrays[item.index]
+    return item
+
+
+def _layout(arrays):
+    """Returns the (offset, dtype, shape) of each array packed into a slot, and the size they take."""
+    layout, offset = [], 0
+    for array in arrays:
+        offset = -(-offset // _ALIGNMENT) * _ALIGNMENT
+        layout.append((offset, array.dtype.str, array.shape))
+        offset += array.nbytes
+    return layout, offset
+
+
+def _release_orphans():
+    """Closes the orphaned blocks whose views have all been garbage collected."""
+    for block in list(_orphaned_blocks):
+        try:
+            block.close()
+        except BufferError:
+            continue
+        _orphaned_blocks.remove(block)
+
+
+class SharedMemoryQueue:
+    """
+    A multiprocessing queue for data pipeline batches which moves arrays through shared memory.
+
+    The queue owns a ring of preallocated shared memory slots. Workers copy the arrays of a
+    batch into a free slot and only send a small descriptor of the slot over a manager queue.
+    The consumer receives numpy views into the slot without copying; the slot is returned to
+    the ring once every view of it has been garbage collected. Batches which do not fit in a
+    slot (which is logged once), or which find no free slot because the consumer still holds
+    on to earlier batches, are sent through the manager queue as is.
+    """
+
+    def __init__(self, manager, maxsize, num_slots, slot_bytes):
+        """
+        Args:
+            manager (multiprocessing.Manager): The manager hosting the descriptor and free slot queues.
+            maxsize (int): The maximum number of batches waiting in the queue.
+            num_slots (int): The number of shared memory slots. Beyond maxsize + number of workers, each extra
+                slot lets the consumer hold on to one more batch without falling back to the manager queue.
+            slot_bytes (int): The size of each slot.
+        """
+        _release_orphans()
+        self.slot_bytes = slot_bytes
+        self._blocks = [shared_memory.SharedMemory(create=True, size=slot_bytes) for _ in range(num_slots)]
+        self._names = [block.name for block in self._blocks]
+        self._free = manager.Queue()
+        for slot in range(num_slots):
+            self._free.put(slot)
+        self._descriptors = manager.Queue(maxsize=maxsize)
+
+    @staticmethod
+    def is_available():
+        """Returns whether shared memory is supported (Python >= 3.8)."""
+        return shared_memory is not None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_blocks']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._blocks = None
+
+    def put(self, batch, block=True, timeout=None):
+        """Enqueues a batch, copying its arrays into a shared memory slot (called by the workers).
+
+        Raises:
+            queue.Full: if the queue is still full after timeout.
+        """
+        arrays = []
+        structure = _flatten(batch, arrays)
+
+        layout, offset = _layout(arrays)
+        slot = None
+        if arrays and offset > self.slot_bytes:
+            if self._names[0] not in _warned_queues:
+                _warned_queues.add(self._names[0])
+                logger.warning("A batch of {} bytes does not fit in the shared memory slots of {} bytes, sending "
+                               "such batches through the slower manager queue.".format(offset, self.slot_bytes))
+        elif arrays:
+            try:
+                slot = self._free.get_nowait()
+            except queue.Empty:
+                logger.debug("No free shared memory slot, sending batch through the queue.")
+
+        if slot is None:
+            self._descriptors.put((None, None, batch), block, timeout)
+            return
+
+        # The slot is only mapped while it is written, so the workers hold no mapping of a closed queue.
+        shm = shared_memory.SharedMemory(name=self._names[slot])
+        try:
+            for array, (array_offset, dtype, shape) in zip(arrays, layout):
+                np.ndarray(shape, dtype, buffer=shm.buf, offset=array_offset)[...] = array
+        finally:
+            shm.close()
+        try:
+            self._descriptors.put((slot, layout, structure), block, timeout)
+        except queue.Full:
+            self._free.put(slot)
+            raise
+
+    def put_nowait(self, batch):
+        self.put(batch, block=False)
+
+    def get(self, block=True, timeout=None):
+        """Dequeues a batch whose arrays are views into shared memory (called by the consumer).
+
+        Raises:
+            queue.Empty: if no batch is available.
+        """
+        slot, layout, structure = self._descriptors.get(block, timeout)
+        if slot is None:
+            return structure
+
+        base = np.frombuffer(self._blocks[slot].buf, dtype=np.uint8)
+        weakref.finalize(base, self._release, self._free, slot)
+        arrays = [np.ndarray(shape, dtype, buffer=base, offset=offset) for offset, dtype, shape in layout]
+        return _unflatten(structure, arrays)
+
+    def get_nowait(self):
+        return self.get(block=False)
+
+    @staticmethod
+    def _release(free, slot):
+        try:
+            free.put(slot)
+        except (OSError, EOFError, BrokenPipeError):
+            pass
+        _release_orphans()
+
+    def close(self):
+        """Unlinks the shared memory slots. Views which are still alive stay valid in this process, their slots
+        are unmapped once they have been garbage collected."""
+        for block in self._blocks or []:
+            try:
+                block.close()
+            except BufferError:
+                # Views are still exported, keep the mapping alive for them.
+                _orphaned_blocks.append(block)
+            try:
+                block.unlink()
+            except FileNotFoundError:
+                pass
+        self._blocks = []
+        _release_orphans()
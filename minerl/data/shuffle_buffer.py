@@ -0,0 +1,90 @@
+import numpy as np
+
+from minerl.data.shared_memory_queue import _overlapping_base
+
+
+def _nbytes(item, bases=None):
+    """The size of the arrays of item, counting the block of frames behind stacked frame views once."""
+    if bases is None:
+        bases = set()
+    if isinstance(item, dict):
+        return sum(_nbytes(v, bases) for v in item.values())
+    if isinstance(item, (list, tuple)):
+        return sum(_nbytes(v, bases) for v in item)
+    if isinstance(item, np.ndarray):
+        view = _overlapping_base(item) if item.size > 0 else None
+        if view is None:
+            return item.nbytes
+        if id(view[0]) in bases:
+            return 0
+        bases.add(id(view[0]))
+        return view[0].nbytes
+    return 0
+
+
+def _copy(item, bases=None):
+    """Copies the arrays of item. Views which overlap themselves (e.g. stacked frames) are rebuilt on a copy of
+    their base, which is only copied once, rather than expanded into full arrays."""
+    if bases is None:
+        bases = {}
+    if isinstance(item, dict):
+        return type(item)((k, _copy(v, bases)) for k, v in item.items())
+    if isinstance(item, (list, tuple)):
+        return type(item)(_copy(v, bases) for v in item)
+    if isinstance(item, np.ndarray):
+        view = _overlapping_base(item) if item.size > 0 else None
+        if view is None:
+            return np.array(item)
+        base, offset = view
+        if id(base) not in bases:
+            bases[id(base)] = base.copy()
+        return np.ndarray(item.shape, item.dtype, buffer=bases[id(base)], offset=offset, strides=item.strides)
+    return item
+
+
+def shuffle_buffer(items, buffer_size=None, buffer_bytes=None, rng=None, copy=False):
+    """Shuffles a stream of items through a bounded pool.
+
+    Items are added to the pool until it holds buffer_size items or more than buffer_bytes bytes
+    of arrays; a uniformly chosen item of the pool is then yielded for every new item. The pool
+    is drained in random order once the stream ends.
+
+    Args:
+        items (iterable): The items to shuffle, e.g. the tuples yielded by DataPipeline.sarsd_iter.
+        buffer_size (int, optional): The maximum number of items in the pool. Defaults to None (unbounded).
+        buffer_bytes (int, optional): The maximum size of the arrays in the pool. Defaults to None (unbounded).
+        rng (np.random.RandomState, optional): The random state used to choose items. Defaults to a fresh
+            random state.
+        copy (bool, optional): Whether to copy the arrays of items entering the pool, e.g. to release shared
+            memory. Defaults to False.
+
+    Yields:
+        The items in shuffled order.
+    """
+    if rng is None:
+        rng = np.random.RandomState()
+
+    pool, pool_bytes = [], 0
+
+    def _pop():
+        nonlocal pool_bytes
+        idx = rng.randint(len(pool))
+        pool[idx], pool[-1] = pool[-1], pool[idx]
+        item, item_bytes = pool.pop()
+        pool_bytes -= item_bytes
+        return item
+
+    for item in items:
+        if copy:
+            item = _copy(item)
+        item_bytes = _nbytes(item)
+        pool.append((item, item_bytes))
+        pool_bytes += item_bytes
+        del item
+
+        while pool and ((buffer_size is not None and len(pool) >= buffer_size)
+                        or (buffer_bytes is not None and pool_bytes > buffer_bytes)):
+            yield _pop()
+
+    while pool:
+        yield _pop()
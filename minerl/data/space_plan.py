@@ -0,0 +1,137 @@
+import collections
+
+import gym
+import numpy as np
+
+from minerl.env import spaces
+
+# Dict spaces whose members are stored as separate npz arrays rather than as columns of one array.
+_FLATTENED_DICT_KEYS = ['equipped_items', 'mainhand']
+
+_plans = {}
+
+
+class SpacePlan:
+    """
+    A compiled mapping from the arrays loaded by the data pipeline to the nested dict of a space.
+
+    The arrays (handler list) are the npz arrays of a trajectory ordered by key, with pov last.
+    Each leaf of the space is either one of the arrays (for the members of equipped_items and
+    mainhand), or a column of one of them (e.g. the members of inventory). The space is walked
+    once when the plan is compiled; applying it only indexes the arrays.
+    """
+
+    def __init__(self, space: gym.spaces.Space):
+        # (array index, columns) of every leaf, and the nested (key, leaf number or subtree) template.
+        self.leaves = []
+        self.template = []
+
+        index = 0
+        for key, s in space.spaces.items():
+            index = self._compile(key, s, index, (), self.template)
+
+    def _compile(self, key, space, index, columns, template):
+        if isinstance(space, spaces.Dict):
+            subtree = []
+            template.append((key, subtree))
+            if key in _FLATTENED_DICT_KEYS:
+                for k, s in space.spaces.items():
+                    index = self._compile(k, s, index, columns, subtree)
+                return index
+            for column, (k, s) in enumerate(space.spaces.items()):
+                self._compile(k, s, index, columns + (column,), subtree)
+            return index + 1
+
+        template.append((key, len(self.leaves)))
+        self.leaves.append((index, columns))
+        return index + 1
+
+    def flatten(self, handler_list):
+        """Returns the array of every leaf of the space, in the order of the plan's leaves.
+        """
+        flat = []
+        for index, columns in self.leaves:
+            value = handler_list[index]
+            for column in columns:
+                value = value.T[column]
+            flat.append(value)
+        return flat
+
+    def unflatten(self, flat):
+        """Builds the nested dict of the space from the arrays returned by flatten.
+        """
+        return _build(self.template, flat)
+
+    def __call__(self, handler_list):
+        """Maps a handler list to the nested dict of the space.
+        """
+        return self.unflatten(self.flatten(handler_list))
+
+    def to_handler_list(self, tree):
+        """Maps a nested dict of the space back to a handler list (the inverse of applying the plan).
+
+        Leaves which are columns of one array (e.g. the members of inventory) are stacked along the last axis.
+        """
+        handler_list = [None] * (max(index for index, _ in self.leaves) + 1 if self.leaves else 0)
+        stacked = collections.OrderedDict()
+        for (index, columns), value in zip(self.leaves, _leaf_values(self.template, tree)):
+            if columns:
+                stacked.setdefault(index, []).append(value)
+            else:
+                handler_list[index] = value
+        for index, values in stacked.items():
+            handler_list[index] = np.stack(values, axis=-1)
+        return handler_list
+
+    def iter_steps(self, handler_list):
+        """Yields the nested dict of every step of a handler list of whole sequences.
+
+        Columns are extracted once for the whole sequence rather than once per step.
+        """
+        flat = self.flatten(handler_list)
+        num_steps = len(flat[0]) if flat else 0
+        for idx in range(num_steps):
+            yield self.unflatten([value[idx] for value in flat])
+
+
+def _build(template, flat):
+    return collections.OrderedDict(
+        (key, _build(node, flat) if isinstance(node, list) else flat[node]) for key, node in template)
+
+
+def _leaf_values(template, tree):
+    for key, node in template:
+        if isinstance(node, list):
+            yield from _leaf_values(node, tree[key])
+        else:
+            yield tree[key]
+
+
+def select_space(space, keys=None):
+    """Returns the Dict space of the given top-level keys of a Dict space, in the space's order.
+
+    Args:
+        space (spaces.Dict): The space.
+        keys (iterable, optional): The keys to keep, e.g. ['inventory', 'pov']. Defaults to None (all of them).
+    """
+    if keys is None:
+        return space
+    keys = set(keys)
+    unknown = keys.difference(space.spaces)
+    if unknown:
+        raise ValueError("The space has no keys {}.".format(", ".join(sorted(unknown))))
+    return spaces.Dict(collections.OrderedDict((k, s) for k, s in space.spaces.items() if k in keys))
+
+
+def get_space_plans(environment: str, observation_keys=None, action_keys=None):
+    """Returns the compiled (observation, action) SpacePlans of a MineRL environment, or of the given top-level
+    keys of its spaces (see select_space).
+    """
+    key = (environment,
+           tuple(sorted(observation_keys)) if observation_keys is not None else None,
+           tuple(sorted(action_keys)) if action_keys is not None else None)
+    if key not in _plans:
+        spec = gym.envs.registration.spec(environment)
+        _plans[key] = (SpacePlan(select_space(spec._kwargs['observation_space'], observation_keys)),
+                       SpacePlan(select_space(spec._kwargs['action_space'], action_keys)))
+    return _plans[key]
@@ -0,0 +1,382 @@
+import collections
+import json
+import logging
+import os
+import zlib
+
+import gym
+import numpy as np
+
+from minerl.data.decoders import get_decoder
+from minerl.data.frame_index import load_frame_index
+from minerl.data.npz_reader import NpzReader
+from minerl.data.space_plan import get_space_plans
+from minerl.env import spaces
+
+logger = logging.getLogger(__name__)
+
+
+def load_metadata(file_dir, env_str, state):
+    """Loads a trajectory's metadata.json, correcting its success flag for the environment.
+    """
+    with open(os.path.join(file_dir, 'metadata.json')) as file:
+        meta = json.load(file)
+        if 'stream_name' not in meta:
+            meta['stream_name'] = file_dir
+
+        # Hotfix for incorrect success metadata from server [TODO: remove]
+        reward_threshold = {
+            'MineRLTreechop-v0': 64,
+            'MineRLNavigate-v0': 100,
+            'MineRLNavigateExtreme-v0': 100,
+            'MineRLObtainIronPickaxe-v0': 256 + 128 + 64 + 32 + 32 + 16 + 8 + 4 + 4 + 2 + 1,
+            'MineRLObtainDiamond-v0': 1024 + 256 + 128 + 64 + 32 + 32 + 16 + 8 + 4 + 4 + 2 + 1,
+        }
+        reward_list = {
+            'MineRLNavigateDense-v0': [100],
+            'MineRLNavigateExtreme-v0': [100],
+            'MineRLObtainIronPickaxeDense-v0': [256, 128, 64, 32, 32, 16, 8, 4, 4, 2, 1],
+            'MineRLObtainDiamondDense-v0': [1024, 256, 128, 64, 32, 32, 16, 8, 4, 4, 2, 1],
+        }
+
+        try:
+            meta['success'] = meta['total_reward'] >= reward_threshold[env_str]
+        except KeyError:
+            try:
+                # For dense env use set of rewards (assume all disjoint rewards) within 8 of reward is good
+                quantized_reward_vec = int(state['total_reward'] // 8)
+                meta['success'] = all(reward//8 in quantized_reward_vec for reward in reward_list[env_str])
+            except KeyError:
+                logger.warning("success in metadata may be incorrect")
+    return meta
+
+
+def aggregate_steps(values, states, enum=None):
+    """Merges the values of the steps between consecutive states, e.g. the actions of a subsampled trajectory.
+
+    Float values (camera deltas and rewards) are summed, integer values (binary keys) are OR-ed and
+    enum values keep their first value which is not 'none'.
+
+    Args:
+        values (np.ndarray): The values of every step, indexed by their first dimension.
+        states (np.ndarray): Increasing state indices; the steps [states[i], states[i + 1]) are merged.
+        enum (spaces.Enum, optional): The space of the values if they are an enum, which may be stored as integer
+            codes. Defaults to None, for which values stored as strings are enums.
+
+    Returns:
+        The len(states) - 1 merged values.
+    """
+    values = np.asarray(values[states[0]:states[-1]])
+    starts = states[:-1] - states[0]
+    if len(starts) == 0:
+        return values[:0]
+
+    if enum is not None or values.dtype.kind in 'OUS':
+        if values.dtype.kind in 'OUS':
+            none = b'none' if values.dtype.kind == 'S' else 'none'
+        else:
+            none = enum.values.index('none') if 'none' in enum.values else None
+        positions = np.arange(len(values))
+        first = np.minimum.reduceat(np.where(values != none, positions, len(values)), starts)
+        stops = np.append(starts[1:], len(values))
+        return values[np.where(first < stops, first, starts)]
+    if np.issubdtype(values.dtype, np.floating):
+        return np.add.reduceat(values, starts)
+    return np.maximum.reduceat(values, starts)
+
+
+def _selected(npz_key, prefix, keys):
+    """Returns whether an npz key (e.g. observation_equipped_items.mainhand.type) belongs to one of the top-level
+    space keys (e.g. equipped_items), or to any if keys is None."""
+    if not npz_key.startswith(prefix):
+        return False
+    return keys is None or npz_key[len(prefix):].split('.')[0] in keys
+
+
+class Trajectory:
+    """
+    Random access to the steps of an individual trajectory of the MineRL dataset.
+
+    Indexing a trajectory with a slice, :code:`trajectory[t0:t1]`, returns a tuple of
+    (state, player_action, reward_from_action, next_state, is_next_state_terminal) for exactly
+    the steps t0 to t1 - 1 in the format of the environment spaces. Only the frames of that
+    window are decoded, starting from the closest keyframe. Consecutive windows continue
+    decoding from where the previous one stopped, their shared boundary state (and frame
+    history) is kept by the decoder rather than decoded again.
+
+    With a skip_interval of k, k time steps are skipped between each sample: the trajectory is
+    subsampled to every n-th state (and its final state) with n = k + 1, and step t goes from
+    state t * n to state (t + 1) * n. The frames in between are skipped without being decoded to
+    images. Its action and reward are those of step t * n, or with aggregate_actions, those of
+    the steps t * n to (t + 1) * n - 1 merged by aggregate_steps.
+
+    A transform, transform(observation, rng), maps the observations of the states of each loaded
+    window (a dict in the format of the observation space with a leading state axis) to new
+    observations, e.g. resized frames. It is applied once to the states of a window, which are
+    then split into states and next states. Its rng is a np.random.RandomState seeded by seed,
+    the trajectory and the window, so random augmentations are reproducible.
+
+    With a frame_stack of k, the pov of each state is the stack of the frames of its k latest
+    states, of shape (k, H, W, C), padded with the first frame at the start of the episode.
+    The stacks of a window are strided views into one contiguous block of frames.
+
+    With observation_keys or action_keys, only the given top-level keys of the spaces are loaded
+    (e.g. ['inventory'] for a Navigate trajectory). Only their arrays are read from rendered.npz,
+    and uncompressed ones are memory-mapped so that only the steps of each window are read.
+    Without pov, the recording is never opened (nor indexed) and the trajectory has every step
+    of rendered.npz.
+    """
+
+    def __init__(self, file_dir: str, environment: str, frame_cache=None, skip_interval=0, aggregate_actions=False,
+                 transform=None, seed=0, frame_stack=1, decoder='cv2', observation_keys=None, action_keys=None):
+        """
+        Args:
+            file_dir (str): The trajectory directory.
+            environment (str): The MineRL environment the trajectory was recorded in.
+            frame_cache (FrameCache, optional): The cache to read decoded frames from. Defaults to None.
+            skip_interval (int, optional): Number of time steps to skip between each sample. Defaults to 0 (every
+                state).
+            aggregate_actions (bool, optional): Merge the actions and rewards of the skipped steps into the kept
+                ones. Defaults to False.
+            transform (callable, optional): The transform of the observations of each window. Defaults to None.
+            seed (int, optional): The seed of the random states passed to transform. Defaults to 0.
+            frame_stack (int, optional): The number of frames stacked in each pov. Defaults to 1 (no stacking).
+            decoder (str or type, optional): The video decoder backend, a name in minerl.data.decoders.DECODERS or a
+                VideoDecoder subclass. Defaults to 'cv2'.
+            observation_keys (list, optional): The top-level keys of the observation space to load, e.g.
+                ['inventory', 'pov']. Defaults to None (all of them).
+            action_keys (list, optional): The top-level keys of the action space to load. Defaults to None (all
+                of them).
+        """
+        self.file_dir = file_dir
+        self.environment = environment
+        self.skip_interval = max(int(skip_interval), 0)
+        self._stride = self.skip_interval + 1
+        self.aggregate_actions = aggregate_actions
+        self.transform = transform
+        self.seed = seed
+        self.frame_stack = max(int(frame_stack), 1)
+        self.observation_keys = observation_keys
+        self.action_keys = action_keys
+        self._pov = observation_keys is None or 'pov' in observation_keys
+
+        state = NpzReader(os.path.join(file_dir, 'rendered.npz'))
+        self._state = state
+        self._action_dict = collections.OrderedDict(
+            [(key, state[key]) for key in state if _selected(key, 'action_', action_keys)])
+        self._reward_vec = state['reward']
+        self._info_dict = collections.OrderedDict(
+            [(key, state[key]) for key in state if _selected(key, 'observation_', observation_keys)])
+
+        # There is no action or reward for the terminal state of an episode.
+        # Hence in Publish.py we shorten the action and reward vector to reflect this.
+        # We know FOR SURE that the last video frame corresponds to the last state (from Universal.json).
+        num_states = len(self._reward_vec) + 1
+
+        self._cached_frames = None
+        if self._pov and frame_cache is not None:
+            self._cached_frames = frame_cache.get_or_build(file_dir, num_states)
+        if not self._pov:
+            # Only the npz is read, so every one of its states is kept.
+            self._offset = 0
+            num_frames = num_states
+            self._reader = None
+        elif self._cached_frames is not None:
+            # Cached frames are already aligned with the npz.
+            self._offset = 0
+            num_frames = len(self._cached_frames)
+            self._reader = None
+        else:
+            index = load_frame_index(file_dir, num_states)
+            self._offset = index['offset']
+            num_frames = index['num_frames']
+            # The boundary state (and frame history) of each window is kept for the next one.
+            self._reader = get_decoder(decoder)(os.path.join(file_dir, 'recording.mp4'), index,
+                                                num_kept=self.frame_stack)
+
+        self._num_frames = num_frames
+        self._num_steps = max(min(len(self._reward_vec), num_frames - self._offset - 1), 0)
+        self._len = -(-self._num_steps // self._stride)
+        self._metadata = None
+
+    def __len__(self):
+        return self._len
+
+    @property
+    def metadata(self):
+        """The trajectory's metadata.json, with the stream name and success filled in.
+        """
+        if self._metadata is None:
+            self._metadata = load_metadata(self.file_dir, self.environment, self._state)
+        return self._metadata
+
+    def __getitem__(self, item):
+        observation_plan, action_plan = get_space_plans(self.environment, self.observation_keys, self.action_keys)
+
+        if isinstance(item, slice):
+            start, stop, step = item.indices(len(self))
+            if step != 1:
+                raise ValueError("Trajectory slices must be contiguous.")
+            observation_seq, action_seq, reward_seq, next_observation_seq, done_seq = self.load_window(start, stop)
+            return (observation_plan(observation_seq),
+                    action_plan(action_seq),
+                    reward_seq[0],
+                    observation_plan(next_observation_seq),
+                    done_seq[0])
+
+        idx = item + len(self) if item < 0 else item
+        if not 0 <= idx < len(self):
+            raise IndexError("Trajectory index out of range.")
+        observation_seq, action_seq, reward_seq, next_observation_seq, done_seq = self.load_window(idx, idx + 1)
+        return (observation_plan([x[0] for x in observation_seq]),
+                action_plan([x[0] for x in action_seq]),
+                reward_seq[0][0],
+                observation_plan([x[0] for x in next_observation_seq]),
+                done_seq[0][0])
+
+    def _read_frames(self, frame_nums):
+        if self._cached_frames is not None:
+            return np.asarray(self._cached_frames[frame_nums])
+        return self._reader.read_frames(self._offset + frame_nums)
+
+    def _state_indices(self, start, stop):
+        """The npz indices of the (subsampled) states [start, stop], states before the first one map to it."""
+        return np.clip(np.arange(start, stop + 1) * self._stride, 0, self._num_steps)
+
+    def _stack_frames(self, block, num_states):
+        """Views the frames of a block as the stacks of frame_stack consecutive frames ending at each state."""
+        block = np.ascontiguousarray(block)
+        return np.ndarray((num_states, self.frame_stack) + block.shape[1:], block.dtype, buffer=block,
+                          strides=(block.strides[0],) + block.strides)
+
+    def load_window(self, start, stop):
+        """Loads the steps [start, stop) as lists of arrays in the order of the npz keys.
+
+        Returns:
+            A list of [observations, actions, [rewards], next_observations, [dones]] where observations
+            and actions are lists of arrays ordered as the npz keys (with pov last) and can be wrapped in
+            dicts with the environment's SpacePlans. The observations and next observations are views of
+            the same states (see load_sequence).
+        """
+        return split_sequence(self.load_sequence(start, stop))
+
+    def load_sequence(self, start, stop):
+        """Loads the steps [start, stop) as the states [start, stop] and the actions between them.
+
+        Every state is loaded once, rather than once as an observation and once as a next
+        observation, which halves the arrays sent between processes.
+
+        Returns:
+            A list of [states, actions, [rewards], [dones]] where states are the observations of the
+            stop - start + 1 states, which split_sequence splits into the format of load_window.
+        """
+        stop = max(min(stop, len(self)), start)
+        history = self.frame_stack - 1 if self._pov else 0
+        states = self._state_indices(start - history, stop)
+
+        frames = None
+        num_states = len(states)
+        if self._pov:
+            # The final frame is not rendered correctly, so the last state repeats the frame before it.
+            frame_nums = states.copy()
+            if stop == len(self) and stop > start:
+                frame_nums[-1] = self._num_steps - 1
+            frames = self._read_frames(frame_nums)
+            num_states = max(len(frames) - history, 0)
+        stop = start + max(num_states - 1, 0)
+        states = states[history:history + stop - start + 1]
+        current = states[:-1]
+        if history:
+            frames = self._stack_frames(frames, num_states)
+
+        observables = list(self._info_dict.keys()).copy()
+        if self._pov:
+            observables.append('pov')
+        actionables = list(self._action_dict.keys())
+
+        state_data = [None for _ in observables]
+        action_data = [None for _ in actionables]
+
+        try:
+            for i, key in enumerate(observables):
+                if key == 'pov':
+                    state_data[i] = frames
+                elif key == 'observation_compassAngle':
+                    state_data[i] = np.asarray(self._info_dict[key][states, 0])
+                else:
+                    state_data[i] = np.asarray(self._info_dict[key][states])
+
+            if self.transform is not None and stop > start:
+                state_data = self._transform(state_data, start)
+
+            # We are getting (S_t, A_t -> R_t),   S_{t+1}, D_{t+1} so there are less actions and rewards
+            if self.aggregate_actions:
+                enums = self._action_enums()
+                for i, key in enumerate(actionables):
+                    action_data[i] = aggregate_steps(self._action_dict[key], states, enums.get(key))
+                reward_data = np.asanyarray(aggregate_steps(self._reward_vec, states), dtype=np.float32)
+            else:
+                for i, key in enumerate(actionables):
+                    action_data[i] = np.asarray(self._action_dict[key][current])
+                reward_data = np.asarray(self._reward_vec[current], dtype=np.float32)
+
+            done_data = np.zeros(len(reward_data), dtype=bool)
+            if stop == len(self) and len(done_data) > 0:
+                done_data[-1] = True
+        except Exception as err:
+            logger.error("error drawing batch from npz file:", err)
+            raise err
+
+        return [state_data, action_data, [reward_data], [done_data]]
+
+    def _action_enums(self):
+        """The Enum spaces of the actions, by npz key."""
+        action_space = gym.envs.registration.spec(self.environment)._kwargs['action_space']
+        return {'action_' + key: space for key, space in action_space.spaces.items() if isinstance(space, spaces.Enum)}
+
+    def _transform(self, state_data, start):
+        observation_plan, _ = get_space_plans(self.environment, self.observation_keys, self.action_keys)
+        name = os.path.basename(os.path.normpath(self.file_dir))
+        rng = np.random.RandomState([self.seed or 0, zlib.crc32(name.encode()), start])
+        return observation_plan.to_handler_list(self.transform(observation_plan(state_data), rng))
+
+    def load_steps(self, steps):
+        """Loads an arbitrary set of steps, decoding each contiguous run of them once.
+
+        Args:
+            steps (array-like): The steps to load in [0, len(self)), in any order and possibly repeated.
+
+        Returns:
+            The steps in the format of load_window, ordered as requested.
+        """
+        steps = np.asarray(steps, dtype=np.int64)
+        if len(steps) == 0 or steps.min() < 0 or steps.max() >= len(self):
+            raise IndexError("Trajectory steps out of range.")
+        unique, inverse = np.unique(steps, return_inverse=True)
+        runs = np.split(unique, np.flatnonzero(np.diff(unique) > 1) + 1)
+        batch = concatenate_windows([self.load_window(run[0], run[-1] + 1) for run in runs])
+        return [[x[inverse] for x in part] for part in batch]
+
+    def close(self):
+        """Releases the trajectory's video capture and rendered.npz.
+        """
+        if self._reader is not None:
+            self._reader.close()
+        self._state.close()
+
+
+def split_sequence(sequence):
+    """Splits a sequence of Trajectory.load_sequence into the format of Trajectory.load_window.
+
+    The observations and next observations are views of the states offset by one. Any further
+    members of the sequence (e.g. metadata) are kept at the end.
+    """
+    states, actions, rewards, dones = sequence[:4]
+    return [[x[:-1] for x in states], actions, rewards, [x[1:] for x in states], dones] + list(sequence[4:])
+
+
+def concatenate_windows(windows):
+    """Concatenates windows in the format of Trajectory.load_window along the step axis.
+    """
+    return [[np.concatenate([w[part][i] for w in windows]) for i in range(len(windows[0][part]))]
+            for part in range(len(windows[0]))]
@@ -23,12 +23,17 @@ def assert_version(data_directory):
             assert DATA_VERSION <= txt, "more"
             assert DATA_VERSION >= txt, "less"
         else:
-            for exp in os.listdir(data_directory):
-                if 'MineRL' in exp:
-                    exp_dir =  os.path.join(data_directory, exp)
-                    for f in os.listdir(exp_dir):
-                        assert_prefix(os.path.join(exp_dir, f))
-                
+            # Directories which are listed unchanged in the catalog were already checked.
+            from minerl.data.catalog import Catalog
+            catalog = Catalog(data_directory)
+            if not catalog.is_current():
+                for exp in os.listdir(data_directory):
+                    if 'MineRL' in exp:
+                        exp_dir =  os.path.join(data_directory, exp)
+                        for f in os.listdir(exp_dir):
+                            assert_prefix(os.path.join(exp_dir, f))
+                catalog.refresh()
+
     except AssertionError as e:
         _raise_error(e, data_directory)
 
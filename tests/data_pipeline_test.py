@@ -0,0 +1,707 @@
+import collections
+import os
+import pickle
+import shutil
+
+import numpy as np
+import pytest
+
+import minerl
+from minerl.data import DataPipeline, Trajectory
+from minerl.data.decoders import CV2Decoder
+from minerl.data.trajectory import concatenate_windows
+
+ENVIRONMENT = 'MineRLNavigate-v0'
+
+
+def _copy_trajectories(tmp_path, num_trajectories):
+    """Copies the first trajectories of the dataset into a fresh data root."""
+    src = minerl.data.make(ENVIRONMENT)
+    env_dir = tmp_path / ENVIRONMENT
+    env_dir.mkdir()
+    for name in sorted(src.get_trajectory_names())[:num_trajectories]:
+        shutil.copytree(os.path.join(src.data_dir, name), str(env_dir / name))
+    return str(tmp_path)
+
+
+@pytest.fixture
+def data_dir(tmp_path):
+    """A data root with the first trajectory of the dataset."""
+    return _copy_trajectories(tmp_path, 1)
+
+
+@pytest.fixture
+def small_data_dir(tmp_path):
+    """A data root with the first 4 trajectories of the dataset, for tests spanning several trajectories."""
+    return _copy_trajectories(tmp_path, 4)
+
+
+def _make(data_dir, **kwargs):
+    return DataPipeline(os.path.join(data_dir, ENVIRONMENT), ENVIRONMENT, 1, 32, 32, **kwargs)
+
+
+def _flatten(d, prefix=''):
+    out = {}
+    for k, v in d.items():
+        if isinstance(v, dict):
+            out.update(_flatten(v, prefix + k + '.'))
+        else:
+            out[prefix + k] = v
+    return out
+
+
+def _assert_same_batches(a, b):
+    assert len(a) == len(b)
+    for x, y in zip(a, b):
+        for part_x, part_y in zip(x, y):
+            if isinstance(part_x, dict):
+                fx, fy = _flatten(part_x), _flatten(part_y)
+                assert fx.keys() == fy.keys()
+                for k in fx:
+                    np.testing.assert_array_equal(fx[k], fy[k])
+            else:
+                np.testing.assert_array_equal(part_x, part_y)
+
+
+def test_frame_index_is_reused(data_dir):
+    data = _make(data_dir)
+    name = data.get_trajectory_names()[0]
+    first = list(data.sarsd_iter(num_epochs=1, max_sequence_len=32))
+    index_path = os.path.join(data.data_dir, name, minerl.data.frame_index.FRAME_INDEX_FILE_NAME)
+    assert os.path.exists(index_path)
+
+    second = list(data.sarsd_iter(num_epochs=1, max_sequence_len=32))
+    _assert_same_batches(first, second)
+
+
+def test_frame_index_fallback(data_dir, tmp_path_factory, monkeypatch):
+    from minerl.data import frame_index
+    cache_dir = tmp_path_factory.mktemp('cache')
+    monkeypatch.setenv('MINERL_CACHE_DIR', str(cache_dir))
+    # The index can not be written next to the recording, as that directory does not exist.
+    monkeypatch.setattr(frame_index, 'FRAME_INDEX_FILE_NAME', os.path.join('read_only', 'frame_index.json'))
+
+    data = _make(data_dir)
+    file_dir = os.path.join(data.data_dir, data.get_trajectory_names()[0])
+    num_states = len(np.load(os.path.join(file_dir, 'rendered.npz'), allow_pickle=True)['reward']) + 1
+    index = frame_index.load_frame_index(file_dir, num_states)
+    assert len(os.listdir(frame_index.frame_index_cache_dir())) == 1
+
+    # The stored index is reused rather than rebuilt.
+    monkeypatch.setattr(frame_index, 'build_frame_index', None)
+    assert frame_index.load_frame_index(file_dir, num_states) == index
+
+
+def test_frame_cache_matches_video(data_dir):
+    expected = list(_make(data_dir).sarsd_iter(num_epochs=1, max_sequence_len=32))
+    cache = minerl.data.build_frame_cache(data_dir, ENVIRONMENT, num_workers=1)
+    assert len(cache.cached_files()) == 1
+
+    cached = list(_make(data_dir, use_frame_cache=True).sarsd_iter(num_epochs=1, max_sequence_len=32))
+    _assert_same_batches(expected, cached)
+
+
+def test_frame_cache_eviction(data_dir):
+    cache = minerl.data.build_frame_cache(data_dir, ENVIRONMENT, num_workers=1)
+    size = cache.size()
+    assert size > 0
+
+    cache.evict(size - 1)
+    assert cache.size() == 0
+
+
+def test_frame_cache_eviction_failure(tmp_path, monkeypatch):
+    from minerl.data.frame_cache import FrameCache
+    paths = []
+    for i, name in enumerate(['old', 'new']):
+        (tmp_path / name).mkdir()
+        paths.append(FrameCache.path(str(tmp_path / name)))
+        with open(paths[-1], 'wb') as f:
+            f.write(bytes(100))
+        os.utime(paths[-1], (i, i))
+
+    # The oldest file can not be removed, so the space is only freed by evicting the next one.
+    remove = os.remove
+
+    def failing_remove(path):
+        if path == paths[0]:
+            raise OSError("Permission denied")
+        remove(path)
+    monkeypatch.setattr(os, 'remove', failing_remove)
+    cache = FrameCache(str(tmp_path))
+    cache.evict(150)
+    assert cache.cached_files() == [paths[0]]
+
+
+def test_trajectory_slicing(data_dir):
+    data = _make(data_dir)
+    name = data.get_trajectory_names()[0]
+    steps = list(data.load_data(name))
+    trajectory = data.trajectory(name)
+    assert len(trajectory) == len(steps)
+
+    t0, t1 = len(steps) // 3, len(steps) // 3 + 17
+    obs, act, rew, next_obs, done = trajectory[t0:t1]
+    assert len(rew) == t1 - t0
+    for i, (s_obs, s_act, s_rew, s_next_obs, s_done) in enumerate(steps[t0:t1]):
+        for k, v in _flatten(s_obs).items():
+            np.testing.assert_array_equal(_flatten(obs)[k][i], v)
+        for k, v in _flatten(s_act).items():
+            np.testing.assert_array_equal(_flatten(act)[k][i], v)
+        for k, v in _flatten(s_next_obs).items():
+            np.testing.assert_array_equal(_flatten(next_obs)[k][i], v)
+        assert rew[i] == s_rew and done[i] == s_done
+
+    assert trajectory[-1][4]
+
+
+def test_shared_memory_transport(data_dir):
+    data = _make(data_dir)
+    pickled = list(data.sarsd_iter(num_epochs=1, max_sequence_len=16, use_shared_memory=False))
+    shared = list(data.sarsd_iter(num_epochs=1, max_sequence_len=16, use_shared_memory=True))
+    _assert_same_batches(pickled, shared)
+
+
+def test_shared_memory_slot_size(data_dir, caplog):
+    import multiprocessing
+    from minerl.data.shared_memory_queue import SharedMemoryQueue, _flatten, _layout
+    data = _make(data_dir)
+    file_dir = data._get_trajectory_dirs()[0]
+    # The slots are sized from the actual dtypes, including the string arrays of aggregated enum actions.
+    slot_bytes = data._batch_nbytes(file_dir, 16, aggregate_actions=True)
+    for batches, _ in DataPipeline._iter_windows(file_dir, 16, ENVIRONMENT, aggregate_actions=True):
+        arrays = []
+        _flatten(batches, arrays)
+        assert _layout(arrays)[1] <= slot_bytes
+
+    # Batches which do not fit are still delivered, with a warning.
+    with multiprocessing.Manager() as manager:
+        queue = SharedMemoryQueue(manager, 2, 1, 64)
+        try:
+            queue.put([np.arange(100)])
+            assert 'does not fit' in caplog.text
+            np.testing.assert_array_equal(queue.get()[0], np.arange(100))
+        finally:
+            queue.close()
+
+
+def test_sample(data_dir):
+    data = _make(data_dir)
+    steps = list(data.load_data(data.get_trajectory_names()[0]))
+    povs = np.stack([s[0]['pov'] for s in steps])
+
+    obs, act, rew, next_obs, done = data.sample(24)
+    assert obs['pov'].shape == (24,) + data.observation_space.spaces['pov'].shape
+    assert len(rew) == len(done) == 24
+    for k, v in _flatten(act).items():
+        assert len(v) == 24
+    for pov, r in zip(obs['pov'], rew):
+        matches = np.flatnonzero((povs == pov).all(axis=(1, 2, 3)))
+        assert any(steps[t][2] == r for t in matches)
+
+    # Steps beyond the end of the recording are dropped rather than replaced with the last step.
+    from minerl.data.sampling import TransitionIndex
+    index = data._get_transition_index()
+    data._transition_index = TransitionIndex(index.file_dirs, [len(steps) + len(steps)])
+    obs, act, rew, next_obs, done = data.sample(64)
+    assert 0 < len(rew) < 64 and done.sum() <= 1
+
+
+def test_batch_iter(data_dir):
+    data = _make(data_dir)
+    num_steps = len(data.trajectory(data.get_trajectory_names()[0]))
+
+    total = 0
+    for obs, act, rew, next_obs, done, mask in data.batch_iter(batch_size=3, seq_len=10, num_epochs=1):
+        assert obs['pov'].shape == (3, 10) + data.observation_space.spaces['pov'].shape
+        assert rew.shape == done.shape == mask.shape == (3, 10)
+        for k, v in _flatten(act).items():
+            assert v.shape[:2] == (3, 10)
+        assert not rew[~mask].any()
+        total += mask.sum()
+    assert total == num_steps
+
+
+def test_shuffle_buffer(data_dir):
+    data = _make(data_dir)
+    ordered = list(data.sarsd_iter(num_epochs=1, max_sequence_len=1))
+    shuffled = list(data.sarsd_iter(num_epochs=1, max_sequence_len=1, seed=3, shuffle_buffer_size=64))
+    assert len(shuffled) == len(ordered)
+
+    key = lambda batch: (batch[0]['pov'].tobytes(), float(batch[2][0]))
+    assert sorted(map(key, shuffled)) == sorted(map(key, ordered))
+    assert list(map(key, shuffled)) != list(map(key, ordered))
+
+
+def test_shuffle_buffer_copy():
+    from minerl.data.shuffle_buffer import _copy, _nbytes
+    # Stacked frames are views of a block of frames, which is copied once rather than once per stacked frame.
+    frames = np.arange(10 * 4, dtype=np.uint8).reshape(10, 4)
+    stacked = np.ndarray((7, 4, 4), frames.dtype, buffer=frames, strides=(4, 4, 1))
+    item = ({'pov': stacked[:-1]}, {'pov': stacked[1:]})
+    copied = _copy(item)
+    np.testing.assert_array_equal(copied[0]['pov'], stacked[:-1])
+    np.testing.assert_array_equal(copied[1]['pov'], stacked[1:])
+    assert copied[0]['pov'].base is copied[1]['pov'].base
+    assert not np.shares_memory(copied[0]['pov'], frames)
+    assert _nbytes(copied) == frames.nbytes
+
+
+def test_persistent_worker_pool(data_dir):
+    with _make(data_dir) as data:
+        for _ in data.sarsd_iter(num_epochs=2, max_sequence_len=32):
+            pass
+        pool = data._pool
+        pids = sorted(p.pid for p in pool._pool)
+
+        # Abandon an iterator half way, the workers must remain usable.
+        generator = data.sarsd_iter(num_epochs=1, max_sequence_len=1, queue_size=1)
+        next(generator)
+        generator.close()
+        assert len(list(data.sarsd_iter(num_epochs=1, max_sequence_len=32))) > 0
+
+        assert data._pool is pool
+        assert sorted(p.pid for p in pool._pool) == pids
+    assert data._pool is None
+
+
+def test_interleaved_iterators(data_dir):
+    with _make(data_dir) as data:
+        num_steps = len(data.trajectory(data.get_trajectory_names()[0]))
+        first = data.sarsd_iter(num_epochs=1, max_sequence_len=1, queue_size=1, prefetch=0)
+        next(first)
+
+        # The only worker hands the first iterator's trajectory back rather than wait on its full queue.
+        second = data.sarsd_iter(num_epochs=1, max_sequence_len=32, prefetch=0)
+        num_second = len(next(second)[2])
+        assert data.sample(4)[2].shape == (4,)
+        assert num_second + sum(len(batch[2]) for batch in second) == num_steps
+        assert 1 + len(list(first)) == num_steps
+
+
+def test_shared_memory_release(data_dir):
+    import gc
+    from minerl.data import shared_memory_queue
+    with _make(data_dir) as data:
+        sequences = data.sarsd_iter(num_epochs=1, max_sequence_len=8, prefetch=0)
+        batch = next(sequences)
+        sequences.close()
+        # The slot of the batch stays mapped while it is referenced, and is unmapped once it is collected.
+        orphans = list(shared_memory_queue._orphaned_blocks)
+        assert orphans
+        assert batch[0]['pov'].sum() >= 0
+        del batch
+        gc.collect()
+        for _ in data.sarsd_iter(num_epochs=1, max_sequence_len=8):
+            pass
+        assert not any(block in shared_memory_queue._orphaned_blocks for block in orphans)
+
+
+def test_space_plan():
+    import gym
+    from minerl.data.space_plan import SpacePlan
+    space = gym.envs.registration.spec('MineRLObtainDiamond-v0')._kwargs['observation_space']
+    plan = SpacePlan(space)
+    # equipped_items.mainhand takes one array per member (damage, maxDamage, type), then inventory and pov.
+    handler_list = [np.arange(4 * 20).reshape(4, 20) + 100 * i for i in range(5)]
+
+    result = plan(handler_list)
+    assert list(result.keys()) == list(space.spaces.keys())
+    assert list(result['equipped_items']['mainhand'].keys()) == \
+        list(space.spaces['equipped_items'].spaces['mainhand'].spaces.keys())
+    for column, key in enumerate(space.spaces['inventory'].spaces):
+        np.testing.assert_array_equal(result['inventory'][key], handler_list[3][:, column])
+
+    steps = list(plan.iter_steps(handler_list))
+    assert len(steps) == 4
+    _assert_same_batches([[steps[2]]], [[plan([x[2] for x in handler_list])]])
+
+
+def test_filter_data(data_dir):
+    data = _make(data_dir)
+    name = data.get_trajectory_names()[0]
+    summary = data.get_trajectory_metadata()[name]
+    assert summary['num_steps'] > 0
+    assert set(summary['final_inventory']) == {'dirt'}
+    table_path = os.path.join(data_dir, minerl.data.catalog.CATALOG_FILE_NAME)
+    mtime = os.stat(table_path).st_mtime_ns
+
+    successful = minerl.data.filter_data(data, lambda t: t['success'] == summary['success'])
+    assert successful.get_trajectory_names() == [name]
+    assert os.stat(table_path).st_mtime_ns == mtime
+
+    none = successful.filter(lambda t: t['num_steps'] > summary['num_steps'])
+    assert none.get_trajectory_names() == []
+    assert list(none.sarsd_iter(num_epochs=1, max_sequence_len=32)) == []
+
+
+def test_catalog(data_dir):
+    data = _make(data_dir)
+    name = data.get_trajectory_names()[0]
+    catalog_path = os.path.join(data_dir, minerl.data.catalog.CATALOG_FILE_NAME)
+    mtime = os.stat(catalog_path).st_mtime_ns
+
+    assert data.get_trajectory_names() == [name]
+    assert os.stat(catalog_path).st_mtime_ns == mtime
+
+    # Adding a trajectory changes the environment directory, which is rescanned.
+    env_dir = os.path.join(data_dir, ENVIRONMENT)
+    copy = name[:-1] + 'copy'
+    shutil.copytree(os.path.join(env_dir, name), os.path.join(env_dir, copy))
+    assert sorted(data.get_trajectory_names()) == sorted([name, copy])
+
+    catalog = minerl.data.catalog.Catalog(data_dir)
+    assert not catalog.is_current()
+    catalog.refresh()
+    assert catalog.is_current()
+    summary = catalog.summaries(ENVIRONMENT)[os.path.join(env_dir, copy)]
+    assert summary['environment'] == ENVIRONMENT
+    assert summary['file_sizes']['recording.mp4'] > 0
+
+
+@pytest.mark.parametrize('use_frame_cache', [False, True])
+def test_skip_interval(data_dir, use_frame_cache):
+    data = _make(data_dir, use_frame_cache=use_frame_cache)
+    name = data.get_trajectory_names()[0]
+    steps = list(data.load_data(name))
+    # skip_interval is the number of steps skipped between each sample.
+    assert len(data.trajectory(name, skip_interval=1)) == -(-len(steps) // 2)
+    skipped = list(data.load_data(name, skip_interval=3))
+    assert len(skipped) == -(-len(steps) // 4)
+
+    for t, (s_obs, s_act, s_rew, s_next_obs, s_done) in enumerate(skipped):
+        obs, act, rew, _, _ = steps[4 * t]
+        _, _, _, next_obs, _ = steps[min(4 * t + 4, len(steps)) - 1]
+        _assert_same_batches([[s_obs, s_act, s_next_obs]], [[obs, act, next_obs]])
+        assert s_rew == rew and s_done == (t == len(skipped) - 1)
+
+    batches = list(data.sarsd_iter(num_epochs=1, max_sequence_len=8, skip_interval=3))
+    assert sum(len(batch[2]) for batch in batches) == len(skipped)
+
+
+def test_aggregate_actions(data_dir):
+    from minerl.data.trajectory import aggregate_steps
+    states = np.array([0, 2, 5])
+    np.testing.assert_array_equal(aggregate_steps(np.array([1., 2., 3., 4., 5.]), states), [3., 12.])
+    np.testing.assert_array_equal(aggregate_steps(np.array([0, 1, 0, 0, 0]), states), [1, 0])
+    np.testing.assert_array_equal(aggregate_steps(np.array(['none', 'none', 'none', 'dirt', 'stone'], dtype=object),
+                                                  states), ['none', 'dirt'])
+    np.testing.assert_array_equal(aggregate_steps(np.array(['none', 'dirt', 'none', 'none', 'stone']), states),
+                                  ['dirt', 'stone'])
+    np.testing.assert_array_equal(aggregate_steps(np.array([b'none', b'none', b'dirt', b'none', b'none']), states),
+                                  [b'none', b'dirt'])
+    # Integer enum codes are not max-reduced.
+    from minerl.env import spaces
+    np.testing.assert_array_equal(aggregate_steps(np.array([2, 0, 0, 1, 2]), states, spaces.Enum('none', 'dirt', 'stone')),
+                                  [2, 1])
+
+    data = _make(data_dir)
+    name = data.get_trajectory_names()[0]
+    steps = list(data.load_data(name))
+    aggregated = list(data.load_data(name, skip_interval=3, aggregate_actions=True))
+    for t, (_, s_act, s_rew, _, _) in enumerate(aggregated):
+        window = steps[4 * t:4 * t + 4]
+        np.testing.assert_allclose(s_act['camera'], np.sum([act['camera'] for _, act, _, _, _ in window], axis=0),
+                                   rtol=1e-5)
+        assert s_act['forward'] == max(act['forward'] for _, act, _, _, _ in window)
+        placed = [act['place'] for _, act, _, _, _ in window if act['place'] != 'none']
+        assert s_act['place'] == (placed[0] if placed else 'none')
+        assert s_rew == pytest.approx(sum(rew for _, _, rew, _, _ in window))
+
+
+def _downscale(observation, rng):
+    observation['pov'] = observation['pov'][:, ::2, ::2] + rng.randint(2, size=len(observation['pov']))[:, None, None, None]
+    return observation
+
+
+def test_transform(data_dir):
+    data = _make(data_dir, transform=_downscale)
+    name = data.get_trajectory_names()[0]
+    batches = list(data.sarsd_iter(num_epochs=1, max_sequence_len=8))
+    obs, _, _, next_obs, _ = batches[0]
+    assert obs['pov'].shape == (8, 32, 32, 3)
+    np.testing.assert_array_equal(obs['pov'][1:], next_obs['pov'][:-1])
+
+    # The random states only depend on the seed, trajectory and window.
+    _assert_same_batches(batches, list(data.sarsd_iter(num_epochs=1, max_sequence_len=8)))
+    steps = list(data.load_data(name))
+    assert steps[0][0]['pov'].shape == (32, 32, 3)
+    assert data.sample(4)[0]['pov'].shape == (4, 32, 32, 3)
+
+
+def _to_float(observation, rng):
+    observation['pov'] = observation['pov'].astype(np.float32) / 255
+    return observation
+
+
+def test_transform_slot_size(data_dir):
+    from minerl.data.shared_memory_queue import _flatten, _layout
+    # The slots are sized from the transformed window, whose frames are 4 times larger.
+    data = _make(data_dir, transform=_to_float)
+    file_dir = data._get_trajectory_dirs()[0]
+    slot_bytes = data._batch_nbytes(file_dir, 8)
+    assert slot_bytes > _make(data_dir)._batch_nbytes(file_dir, 8)
+    batches, _ = next(DataPipeline._iter_windows(file_dir, 8, ENVIRONMENT, transform=_to_float))
+    arrays = []
+    _flatten(batches, arrays)
+    assert _layout(arrays)[1] <= slot_bytes
+
+    shared = list(data.sarsd_iter(num_epochs=1, max_sequence_len=8, use_shared_memory=True))
+    assert shared[0][0]['pov'].dtype == np.float32
+    _assert_same_batches(list(data.sarsd_iter(num_epochs=1, max_sequence_len=8, use_shared_memory=False)), shared)
+
+
+def test_transform_failure(data_dir):
+    # Tasks whose transform can not be sent to the worker processes fail rather than hang the iterator.
+    data = _make(data_dir, transform=lambda observation, rng: observation)
+    with pytest.raises(Exception):
+        next(data.sarsd_iter(num_epochs=1, max_sequence_len=8))
+    data.close()
+
+
+def test_frame_stack(data_dir):
+    data = _make(data_dir)
+    name = data.get_trajectory_names()[0]
+    steps = list(data.load_data(name))
+    stacked = list(data.load_data(name, frame_stack=4))
+    assert len(stacked) == len(steps)
+    for t in [0, 2, 3, 33, len(steps) - 1]:
+        expected = [steps[max(t - 3 + i, 0)][0]['pov'] for i in range(4)]
+        np.testing.assert_array_equal(stacked[t][0]['pov'], expected)
+        np.testing.assert_array_equal(stacked[t][3]['pov'][-1], steps[t][3]['pov'])
+
+    batches = list(data.sarsd_iter(num_epochs=1, max_sequence_len=32, frame_stack=4))
+    obs, _, _, next_obs, _ = batches[0]
+    assert obs['pov'].shape == (32, 4, 64, 64, 3)
+    # The stacks are views into one block of frames rather than copies.
+    assert not obs['pov'].flags.c_contiguous
+    np.testing.assert_array_equal(obs['pov'][1:, -1], next_obs['pov'][:-1, -1])
+    np.testing.assert_array_equal(obs['pov'][0], [steps[0][0]['pov']] * 4)
+
+
+def test_sum_tree():
+    from minerl.data.sampling import SumTree
+    tree = SumTree(5)
+    tree.update(np.arange(5), [1., 0., 2., 3., 4.])
+    assert tree.total == 10
+    np.testing.assert_array_equal(tree.find([0., 0.99, 1., 2.5, 3., 5.9, 6., 9.99]), [0, 0, 2, 2, 3, 3, 4, 4])
+    tree.update([4, 4], [0., 1.])
+    assert tree.total == 7 and tree[4] == 1
+
+
+def test_prioritized_sampler(data_dir):
+    data = _make(data_dir)
+    sampler = data.prioritized_sampler(alpha=1.0, reward_priority=10.0, seed=0)
+    rewards = np.concatenate([np.load(os.path.join(file_dir, 'rendered.npz'))['reward']
+                              for file_dir in sampler.index.file_dirs])
+    np.testing.assert_array_equal(sampler.tree[np.arange(len(sampler))], np.where(rewards != 0, 10., 1.))
+
+    obs, act, rew, next_obs, done, indices, weights = sampler.sample(16)
+    assert obs['pov'].shape == (16, 64, 64, 3) and weights.shape == (16,) and weights.max() == 1
+    np.testing.assert_array_equal(rew, rewards[indices])
+
+    sampler.update_priorities(np.arange(len(sampler)), np.zeros(len(sampler)))
+    sampler.update_priorities([3], [1.])
+    assert set(sampler.sample_indices(8)[0]) == {3}
+
+
+def test_shard(small_data_dir):
+    data = _make(small_data_dir)
+    lengths = {name: summary['num_steps'] for name, summary in data.get_trajectory_metadata().items()}
+    shards = [data.shard(rank, 2, seed=3) for rank in range(2)]
+    names = [shard.get_trajectory_names() for shard in shards]
+    assert sorted(names[0] + names[1]) == sorted(lengths)
+    assert abs(sum(lengths[n] for n in names[0]) - sum(lengths[n] for n in names[1])) <= max(lengths.values())
+
+    # Every epoch reshuffles the trajectories identically on every rank.
+    epochs = [[shard._get_trajectory_dirs(epoch) for shard in shards] for epoch in range(4)]
+    assert epochs == [[shard._get_trajectory_dirs(epoch) for shard in shards] for epoch in range(4)]
+    for epoch in epochs:
+        assert sorted(epoch[0] + epoch[1]) == sorted(epochs[0][0] + epochs[0][1])
+
+    streams = {batch[-1]['stream_name'] for batch in shards[0].sarsd_iter(num_epochs=1, include_metadata=True)}
+    assert streams == set(names[0])
+
+
+@pytest.mark.parametrize('shuffle_buffer_size', [None, 4])
+def test_resume(small_data_dir, shuffle_buffer_size):
+    data = _make(small_data_dir)
+    lengths = {name: summary['num_steps'] for name, summary in data.get_trajectory_metadata().items()}
+
+    def iterator():
+        return data.sarsd_iter(num_epochs=2, max_sequence_len=16, seed=1, include_metadata=True,
+                               shuffle_buffer_size=shuffle_buffer_size)
+
+    steps = collections.Counter()
+    sequences = iterator()
+    for _ in range(5):
+        batch = next(sequences)
+        steps[batch[-1]['stream_name']] += len(batch[2])
+    state = pickle.loads(pickle.dumps(sequences.state_dict()))
+    sequences.close()
+
+    # Every step of both epochs is delivered exactly once across the checkpoint.
+    resumed = iterator()
+    resumed.load_state_dict(state)
+    for batch in resumed:
+        steps[batch[-1]['stream_name']] += len(batch[2])
+    assert steps == {name: 2 * length for name, length in lengths.items()}
+
+
+def test_prefetch(data_dir):
+    from minerl.data.prefetch import prefetch
+    assert list(prefetch(iter(range(100)), 3)) == list(range(100))
+
+    def failing():
+        yield 1
+        raise ValueError()
+    items = prefetch(failing(), 2)
+    assert next(items) == 1
+    with pytest.raises(ValueError):
+        next(items)
+
+    # Batches collated ahead by the thread are identical to those collated in place.
+    data = _make(data_dir)
+    num_batches = 0
+    for batch, expected in zip(data.batch_iter(batch_size=2, seq_len=8, num_epochs=1, prefetch=2),
+                               data.batch_iter(batch_size=2, seq_len=8, num_epochs=1, prefetch=0)):
+        for part, expected_part in zip(batch, expected):
+            if isinstance(part, dict):
+                part, expected_part = _flatten(part), _flatten(expected_part)
+                assert all(np.array_equal(part[k], expected_part[k]) for k in part)
+            else:
+                assert np.array_equal(part, expected_part)
+        num_batches += 1
+    assert num_batches > 1
+
+
+@pytest.mark.parametrize('executor', ['threads', 'inline'])
+def test_executor(small_data_dir, executor):
+    expected = _make(small_data_dir)
+    data = _make(small_data_dir, executor=executor)
+
+    def steps(pipeline):
+        key = lambda batch: (batch[-1]['stream_name'], batch[0]['pov'].tobytes(), batch[2].tobytes())
+        return sorted(key(batch) for batch in pipeline.sarsd_iter(num_epochs=1, max_sequence_len=16,
+                                                                   include_metadata=True))
+    assert steps(data) == steps(expected)
+
+    batch = data.sample(8)
+    assert batch[2].shape == (8,)
+    data.close()
+    expected.close()
+
+    with pytest.raises(ValueError):
+        _make(small_data_dir, executor='fibers')
+
+
+class _CountingDecoder(CV2Decoder):
+    num_retrieved = 0
+    num_grabbed = 0
+    num_opened = 0
+
+    def _open(self, keyframe, frame_num):
+        _CountingDecoder.num_opened += 1
+        return super()._open(keyframe, frame_num)
+
+    def _grab(self):
+        _CountingDecoder.num_grabbed += 1
+        return super()._grab()
+
+    def _retrieve(self, frame):
+        _CountingDecoder.num_retrieved += 1
+        return super()._retrieve(frame)
+
+
+@pytest.mark.parametrize('decoder', [_CountingDecoder, 'ffmpeg'])
+def test_decoder(data_dir, decoder, monkeypatch):
+    if decoder == 'ffmpeg' and shutil.which('ffmpeg') is None:
+        pytest.skip("ffmpeg is not installed.")
+    expected = _make(data_dir).trajectory(_make(data_dir).get_trajectory_names()[0])
+    trajectory = Trajectory(expected.file_dir, ENVIRONMENT, decoder=decoder)
+    for start, stop in [(0, 7), (7, 20), (3, 5), (len(trajectory) - 4, len(trajectory))]:
+        for part, expected_part in zip(trajectory.load_window(start, stop), expected.load_window(start, stop)):
+            assert all(np.array_equal(a, b) for a, b in zip(part, expected_part))
+    if decoder is _CountingDecoder:
+        assert _CountingDecoder.num_retrieved > 0
+
+    with pytest.raises(ValueError):
+        _make(data_dir, decoder='gstreamer')
+    # A missing ffmpeg is reported by the pipeline rather than by its workers.
+    monkeypatch.setenv('MINERL_FFMPEG', os.path.join(data_dir, 'missing', 'ffmpeg'))
+    with pytest.raises(RuntimeError):
+        _make(data_dir, decoder='ffmpeg')
+
+
+@pytest.mark.parametrize('frame_stack', [1, 4])
+def test_consecutive_windows(data_dir, frame_stack):
+    name = _make(data_dir).get_trajectory_names()[0]
+    trajectory = Trajectory(os.path.join(_make(data_dir).data_dir, name), ENVIRONMENT, decoder=_CountingDecoder,
+                            frame_stack=frame_stack)
+    _CountingDecoder.num_opened = _CountingDecoder.num_grabbed = _CountingDecoder.num_retrieved = 0
+    windows = [trajectory.load_window(start, start + 32) for start in range(0, len(trajectory), 32)]
+
+    # Every frame is decoded once, the boundary state of each window is kept for the next one.
+    assert _CountingDecoder.num_opened == 1
+    assert _CountingDecoder.num_grabbed + _CountingDecoder.num_retrieved <= trajectory._num_frames
+    expected = _make(data_dir).trajectory(name, frame_stack=frame_stack).load_window(0, len(trajectory))
+    for part, expected_part in zip(concatenate_windows(windows), expected):
+        assert all(np.array_equal(a, b) for a, b in zip(part, expected_part))
+
+
+def test_load_sequence(data_dir):
+    from minerl.data.trajectory import split_sequence
+    trajectory = _make(data_dir).trajectory(_make(data_dir).get_trajectory_names()[0])
+    sequence = trajectory.load_sequence(5, 21)
+    assert all(len(x) == 17 for x in sequence[0])
+
+    # The observations and next observations are views of the states, as sent by the workers.
+    window = split_sequence(sequence)
+    for observation, next_observation in zip(window[0], window[3]):
+        assert np.shares_memory(observation, next_observation) or len(observation) <= 1
+    for part, expected in zip(window, trajectory.load_window(5, 21)):
+        assert all(np.array_equal(a, b) for a, b in zip(part, expected))
+
+
+def test_selected_keys(data_dir):
+    name = _make(data_dir).get_trajectory_names()[0]
+    full = list(_make(data_dir).load_data(name))
+    data = _make(data_dir, observation_keys=['inventory'], action_keys=['camera', 'forward'])
+    assert list(data.observation_space.spaces) == ['inventory']
+    assert list(data.action_space.spaces) == ['camera', 'forward']
+
+    steps = list(data.load_data(name))
+    assert len(steps) == len(full)
+    for step, expected in zip(steps, full):
+        assert list(step[0]) == ['inventory'] and list(step[1]) == ['camera', 'forward']
+        assert np.array_equal(step[0]['inventory']['dirt'], expected[0]['inventory']['dirt'])
+        assert np.array_equal(step[1]['camera'], expected[1]['camera'])
+        assert step[2] == expected[2] and step[4] == expected[4]
+
+    # The recording is not decoded without pov.
+    _CountingDecoder.num_retrieved = 0
+    trajectory = Trajectory(os.path.join(data.data_dir, name), ENVIRONMENT, decoder=_CountingDecoder,
+                            observation_keys=['compassAngle'])
+    assert len(trajectory[0:10][0]['compassAngle']) == 10
+    assert _CountingDecoder.num_retrieved == 0
+
+    with pytest.raises(ValueError):
+        _make(data_dir, observation_keys=['pov', 'compass'])
+
+
+def test_column_iter(data_dir):
+    data = _make(data_dir, decoder=_CountingDecoder)
+    _CountingDecoder.num_retrieved = 0
+    trajectories = list(data.column_iter(seed=1, include_metadata=True))
+    assert len(trajectories) == len(data.get_trajectory_names())
+    assert _CountingDecoder.num_retrieved == 0
+
+    for observation, action, reward, next_observation, done, meta in trajectories:
+        assert sorted(observation) == ['compassAngle', 'inventory']
+        assert len(reward) == len(done) == len(observation['compassAngle']) == len(action['camera'])
+        assert done[-1] and not done[:-1].any()
+        assert np.array_equal(observation['compassAngle'][1:], next_observation['compassAngle'][:-1])
+
+        steps = list(data.load_data(meta['stream_name']))
+        assert np.array_equal(reward, [step[2] for step in steps])
+        assert np.array_equal(observation['inventory']['dirt'], [step[0]['inventory']['dirt'] for step in steps])
@@ -0,0 +1,48 @@
+import os
+import shutil
+import sys
+import time
+
+import minerl
+from minerl.data.decoders import DECODERS
+from minerl.data.trajectory import Trajectory
+
+
+def _load_trajectories(decoder, file_dirs, environment, seq_len):
+    num_frames = 0
+    for file_dir in file_dirs:
+        trajectory = Trajectory(file_dir, environment, decoder=decoder)
+        for start_idx in range(0, len(trajectory), seq_len):
+            num_frames += len(trajectory.load_window(start_idx, start_idx + seq_len)[2][0])
+        trajectory.close()
+    return num_frames
+
+
+def time_decoder(decoder, environment='MineRLObtainDiamond-v0', num_trajectories=5, seq_len=128):
+    """Returns the number of frames per second decoded by a backend over the same trajectories.
+
+    The frame indexes are built and the recordings read by an untimed pass first, so that no
+    backend pays for them.
+    """
+    d = minerl.data.make(environment)
+    file_dirs = [os.path.join(d.data_dir, name) for name in sorted(d.get_trajectory_names())[:num_trajectories]]
+    _load_trajectories(decoder, file_dirs, environment, seq_len)
+
+    start = time.time()
+    num_frames = _load_trajectories(decoder, file_dirs, environment, seq_len)
+    return num_frames / (time.time() - start)
+
+
+def available_decoders():
+    return [name for name in DECODERS if name != 'ffmpeg' or shutil.which('ffmpeg') is not None]
+
+
+if __name__ == '__main__':
+    environment = sys.argv[1] if len(sys.argv) > 1 else 'MineRLObtainDiamond-v0'
+    for decoder in available_decoders():
+        print("{}: {:.1f} frames per second".format(decoder, time_decoder(decoder, environment)))
+
+
+def test_decoders():
+    for decoder in available_decoders():
+        assert time_decoder(decoder) > 0